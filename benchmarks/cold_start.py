@@ -0,0 +1,99 @@
+'''Cold-start budget for lcfsLambdaLib
+
+Imports the library in fresh interpreters with -X importtime, reports the
+slowest modules in the import tree and times the first aws_client call. Exits
+non-zero when the import cost passes the budget or when one of the deferred
+libraries is pulled in at import time, so it can be wired into CI as a guard.
+
+    python benchmarks/cold_start.py --runs 5 --max-import-ms 150 --json out.json
+'''
+import argparse, json, os, statistics, subprocess, sys
+
+MODULE = 'lcfsLambdaLib.lcfsLambdaLib'
+#these must not be imported until a helper actually needs them
+DEFERRED = ('boto3', 'botocore', 'dropbox', 'urllib3', 'email.mime', 'asyncio')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_CALL = '''
+import json, os, sys, time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+t0 = time.perf_counter()
+import {module} as lib
+t1 = time.perf_counter()
+loaded = sorted(m for m in sys.modules if m.split('.')[0] in ('boto3', 'botocore', 'dropbox', 'urllib3') or m.startswith('email.mime'))
+lib.aws_client('ssm')
+t2 = time.perf_counter()
+print(json.dumps({{'import_ms': (t1 - t0) * 1000, 'first_client_ms': (t2 - t1) * 1000, 'loaded_at_import': loaded}}))
+'''.format(module=MODULE)
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+def importtime_breakdown():
+    '''Runs one import under -X importtime and returns (cumulative_us, {module: (self_us, cumulative_us)})'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {MODULE}'],
+                          env=_env(), capture_output=True, text=True, check=True)
+    rows = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        rows[name.strip()] = (int(self_us), int(cum_us))
+    return rows[MODULE][1], rows
+
+def first_call():
+    '''Imports the library and builds the first ssm client in a fresh interpreter'''
+    proc = subprocess.run([sys.executable, '-c', FIRST_CALL], env=_env(), capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--runs', type=int, default=5)
+    ap.add_argument('--top', type=int, default=15)
+    ap.add_argument('--max-import-ms', type=float, default=float(os.environ.get('LCFS_MAX_IMPORT_MS', 250)),
+                    help='fail when the median cumulative import time passes this')
+    ap.add_argument('--json', help='write the results to this file')
+    args = ap.parse_args(argv)
+
+    totals, breakdown = [], {}
+    for _ in range(args.runs):
+        total, rows = importtime_breakdown()
+        totals.append(total / 1000)
+        breakdown = rows
+    calls = [first_call() for _ in range(args.runs)]
+
+    eager = sorted(m for m in breakdown if any(m == d or m.startswith(d + '.') for d in DEFERRED))
+    top = sorted(breakdown.items(), key=lambda kv: kv[1][0], reverse=True)[:args.top]
+    result = {
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'import_ms': {'median': statistics.median(totals), 'min': min(totals), 'max': max(totals)},
+        'first_client_ms': statistics.median(c['first_client_ms'] for c in calls),
+        'top_self_us': [{'module': m, 'self_us': s, 'cumulative_us': c} for m, (s, c) in top],
+        'eager_deferred_modules': eager,
+        'max_import_ms': args.max_import_ms,
+    }
+
+    print(f"import {MODULE}: median {result['import_ms']['median']:.1f} ms over {args.runs} runs "
+          f"(min {result['import_ms']['min']:.1f}, max {result['import_ms']['max']:.1f})")
+    print(f"first aws_client('ssm'): median {result['first_client_ms']:.1f} ms")
+    print(f'{"self us":>10} {"cum us":>10}  module')
+    for row in result['top_self_us']:
+        print(f"{row['self_us']:>10} {row['cumulative_us']:>10}  {row['module']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    failed = False
+    if eager:
+        print(f'FAIL: deferred modules imported at load: {", ".join(eager)}')
+        failed = True
+    if result['import_ms']['median'] > args.max_import_ms:
+        print(f"FAIL: import {result['import_ms']['median']:.1f} ms is over the {args.max_import_ms:.0f} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+'''Local stand-ins for the services lcfsLambdaLib talks to
+
+FakeDropbox is a real dropbox.Dropbox client whose request method is served
+from memory, so the SDK argument and result types, and the timing wrapper the
+library puts on request, are exercised exactly as they are against the api.
+TokenizationServer imitates the vault endpoint over real HTTP on localhost.
+AWS services come from moto's mock_aws.
+'''
+import hashlib, json, threading, uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dropbox
+from dropbox import files
+
+DBX_BLOCK_SIZE = 4 * 1024 * 1024
+
+def dropbox_content_hash(data):
+    '''The dropbox content_hash, sha256 over the sha256 of each 4 MB block'''
+    blocks = b''.join(hashlib.sha256(data[i:i + DBX_BLOCK_SIZE]).digest()
+                      for i in range(0, len(data), DBX_BLOCK_SIZE))
+    return hashlib.sha256(blocks).hexdigest()
+
+class _DownloadResponse:
+    '''Just enough of a requests.Response for files_download callers'''
+
+    def __init__(self, data):
+        self.data = data
+        self.headers = {'content-length': str(len(data))}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+class FakeDropbox(dropbox.Dropbox):
+    '''In memory Dropbox account
+    :param: page_size=entries per list_folder page, to exercise the cursor
+    :param: latency=seconds added to every api call to stand in for the network
+    '''
+
+    def __init__(self, page_size=500, latency=0.0):
+        super().__init__('fake-token')
+        self.page_size = page_size
+        self.latency = latency
+        self.files = {}
+        self.folders = {''}
+        self.sessions = {}
+        self.cursors = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _file_meta(self, path, data):
+        return files.FileMetadata(name=path.rsplit('/', 1)[-1], id=f'id:{path.lower()}',
+                                  client_modified=datetime(2020, 1, 1), server_modified=datetime(2020, 1, 1),
+                                  rev='0123456789a', size=len(data), path_lower=path.lower(),
+                                  path_display=path, content_hash=dropbox_content_hash(data))
+
+    def _folder_meta(self, path):
+        return files.FolderMetadata(name=path.rsplit('/', 1)[-1], id=f'id:{path.lower()}',
+                                    path_lower=path.lower(), path_display=path)
+
+    def _lookup_error(self, route):
+        error = files.DownloadError if route.name == 'download' else files.GetMetadataError
+        return dropbox.exceptions.ApiError(str(uuid.uuid4()), error.path(files.LookupError.not_found),
+                                           'path/not_found/', None)
+
+    def _put_file(self, path, data):
+        with self._lock:
+            self.files[path.lower()] = (path, bytes(data))
+            parent = path.rsplit('/', 1)[0]
+            while parent.lower() not in self.folders:
+                self.folders.add(parent.lower())
+                parent = parent.rsplit('/', 1)[0]
+        return self._file_meta(path, data)
+
+    def _list(self, path, recursive):
+        prefix = path.lower().rstrip('/') + '/'
+        if path.lower().rstrip('/') not in self.folders:
+            raise dropbox.exceptions.ApiError(str(uuid.uuid4()),
+                                              files.ListFolderError.path(files.LookupError.not_found),
+                                              'path/not_found/', None)
+        entries = []
+        for folder in sorted(self.folders):
+            rest = folder[len(prefix):]
+            if folder.startswith(prefix) and (recursive or '/' not in rest):
+                entries.append(self._folder_meta(folder))
+        for key, (display, data) in sorted(self.files.items()):
+            rest = key[len(prefix):]
+            if key.startswith(prefix) and (recursive or '/' not in rest):
+                entries.append(self._file_meta(display, data))
+        return entries
+
+    def _page(self, entries):
+        page, rest = entries[:self.page_size], entries[self.page_size:]
+        cursor = str(uuid.uuid4())
+        self.cursors[cursor] = rest
+        return files.ListFolderResult(entries=page, cursor=cursor, has_more=bool(rest))
+
+    def _conflict(self, path):
+        '''The WriteConflictError creating a folder at path runs into, or None'''
+        key = path.lower()
+        if key in self.folders:
+            return files.WriteConflictError.folder
+        if key in self.files:
+            return files.WriteConflictError.file
+        parent = key.rsplit('/', 1)[0]
+        while parent:
+            if parent in self.files:
+                return files.WriteConflictError.file_ancestor
+            parent = parent.rsplit('/', 1)[0]
+        return None
+
+    def _create_folder(self, path):
+        '''Returns (metadata, None) or (None, the conflict)'''
+        with self._lock:
+            conflict = self._conflict(path)
+            if conflict is not None:
+                return None, conflict
+            self.folders.add(path.lower())
+        return self._folder_meta(path), None
+
+    def request(self, route, namespace, request_arg, request_binary, timeout=None, extra_headers=None):
+        if self.latency:
+            threading.Event().wait(self.latency)
+        with self._lock:
+            self.calls[route.name] = self.calls.get(route.name, 0) + 1
+        name = route.name
+        if name == 'upload':
+            return self._put_file(request_arg.path, request_binary)
+        if name == 'upload_session/start':
+            session_id = str(uuid.uuid4())
+            self.sessions[session_id] = bytearray(request_binary or b'')
+            return files.UploadSessionStartResult(session_id=session_id)
+        if name == 'upload_session/append':
+            buf = self.sessions[request_arg.cursor.session_id]
+            assert len(buf) == request_arg.cursor.offset, 'upload session offset mismatch'
+            buf += request_binary
+            return None
+        if name == 'upload_session/finish':
+            buf = self.sessions.pop(request_arg.cursor.session_id)
+            assert len(buf) == request_arg.cursor.offset, 'upload session offset mismatch'
+            buf += request_binary or b''
+            return self._put_file(request_arg.commit.path, buf)
+        if name == 'download':
+            hit = self.files.get(request_arg.path.lower())
+            if hit is None:
+                raise self._lookup_error(route)
+            return self._file_meta(*hit), _DownloadResponse(hit[1])
+        if name == 'get_metadata':
+            path = request_arg.path.lower()
+            if path in self.files:
+                return self._file_meta(*self.files[path])
+            if path in self.folders:
+                return self._folder_meta(request_arg.path)
+            raise self._lookup_error(route)
+        if name == 'list_folder':
+            return self._page(self._list(request_arg.path, request_arg.recursive))
+        if name == 'list_folder/continue':
+            return self._page(self.cursors.pop(request_arg.cursor))
+        if name == 'create_folder':
+            meta, conflict = self._create_folder(request_arg.path)
+            if meta is None:
+                raise dropbox.exceptions.ApiError(str(uuid.uuid4()), files.CreateFolderError.path(
+                    files.WriteError.conflict(conflict)), 'path/conflict/', None)
+            return files.CreateFolderResult(metadata=meta)
+        if name == 'create_folder_batch':
+            entries = []
+            for path in request_arg.paths:
+                meta, conflict = self._create_folder(path)
+                if meta is None:
+                    entries.append(files.CreateFolderBatchResultEntry.failure(files.CreateFolderEntryError.path(
+                        files.WriteError.conflict(conflict))))
+                else:
+                    entries.append(files.CreateFolderBatchResultEntry.success(
+                        files.CreateFolderEntryResult(metadata=meta)))
+            return files.CreateFolderBatchLaunch.complete(files.CreateFolderBatchResult(entries=entries))
+        raise NotImplementedError(f'FakeDropbox does not serve {name}')
+
+class _TokenizationHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #buffer the reply so headers and body leave in one segment, otherwise
+    #nagle and delayed acks add ~40 ms to every keep-alive request
+    wbufsize = -1
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            fail = server.fail_every and server.calls % server.fail_every == 0
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if server.latency:
+            threading.Event().wait(server.latency)
+        if fail:
+            self._reply(503, {'message': 'Service Unavailable'})
+        elif 'plaintext_item' in body:
+            self._reply(200, {'token': 'tok-' + hashlib.sha256(body['plaintext_item'].encode()).hexdigest()[:24]})
+        elif 'token' in body:
+            self._reply(200, {'hash': hashlib.sha256(body['token'].encode()).hexdigest()})
+        elif 'hash' in body:
+            self._reply(200, {'plaintext_value': 'pt-' + body['hash'][:16]})
+        else:
+            self._reply(400, {'message': 'Bad Request'})
+
+    def _reply(self, status, item):
+        data = json.dumps(item).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class TokenizationServer:
+    '''Local HTTP server answering like the tokenization endpoint
+    :param: fail_every=answer every nth request with a 503, 0 never fails
+    :param: latency=seconds added to every request to stand in for the network
+    '''
+
+    def __init__(self, fail_every=0, latency=0.0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _TokenizationHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.calls = 0
+        self.httpd.fail_every = fail_every
+        self.httpd.latency = latency
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/vault'
+
+    @property
+    def calls(self):
+        return self.httpd.calls
+
+    @property
+    def latency(self):
+        return self.httpd.latency
+
+    @latency.setter
+    def latency(self, seconds):
+        self.httpd.latency = seconds
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return False
@@ -0,0 +1,496 @@
+'''Offline benchmark suite for the lcfsLambdaLib helpers
+
+Runs the helpers against moto (S3, SQS, SNS, SSM, DynamoDB, SES), an in memory
+Dropbox client and a local tokenization server, across payload and batch
+sizes. For each case it reports per call latency percentiles, calls (and
+items) per second and the peak RSS seen while the case ran, and writes the
+results as JSON so two releases can be diffed.
+
+    python benchmarks/suite.py --json before.json
+    python benchmarks/suite.py --json after.json --compare before.json
+    python benchmarks/suite.py --quick --only s3,vault
+
+Numbers include moto's own overhead, so compare runs against each other on
+the same machine rather than reading them as production latencies.
+'''
+import argparse, gc, json, logging, os, platform, resource, statistics, subprocess, sys, threading, time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.pop('AWS_PROFILE', None)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import boto3
+from moto import mock_aws
+from standins import FakeDropbox, TokenizationServer
+from lcfsLambdaLib import lcfsLambdaLib as lib
+
+KB = 1024
+MB = 1024 * 1024
+BUCKET = 'lcfs-bench'
+QUEUE = 'lcfs-bench'
+TABLE = 'lcfs-bench-transactions'
+SENDER = 'bench@example.com'
+
+log = logging.getLogger('lcfs.bench')
+
+def _payload(size):
+    '''Text of exactly size bytes'''
+    line = 'lcfs benchmark payload 0123456789 abcdefghijklmnopqrstuvwxyz\n'
+    return (line * (size // len(line) + 1))[:size]
+
+class RssSampler:
+    '''Samples the process RSS on a background thread while a case runs.
+    Reads /proc/self/statm where there is one and falls back to ru_maxrss,
+    which can only go up, elsewhere
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self._statm = os.path.exists('/proc/self/statm')
+
+    def rss(self):
+        if self._statm:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        gc.collect()
+        self.start = self.peak = self.rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+        return False
+
+def _percentile(sorted_values, pct):
+    '''Nearest rank percentile of an already sorted list'''
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+def measure(fn, iterations, items=1, max_seconds=None, warmup=1, reset=None):
+    '''Times fn over iterations calls and returns the latency and rss stats,
+    reset runs untimed before every call'''
+    for _ in range(warmup):
+        if reset:
+            reset()
+        fn()
+    samples = []
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        for _ in range(iterations):
+            if reset:
+                reset()
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+            if max_seconds and time.perf_counter() - t0 > max_seconds and len(samples) >= 3:
+                break
+        total = sum(samples)
+    ordered = sorted(s * 1000 for s in samples)
+    return {
+        'iterations': len(samples),
+        'latency_ms': {
+            'min': round(ordered[0], 3),
+            'p50': round(_percentile(ordered, 50), 3),
+            'p90': round(_percentile(ordered, 90), 3),
+            'p99': round(_percentile(ordered, 99), 3),
+            'max': round(ordered[-1], 3),
+            'mean': round(statistics.fmean(ordered), 3),
+        },
+        'calls_per_sec': round(len(samples) / total, 2),
+        'items_per_sec': round(len(samples) * items / total, 2),
+        'rss_peak_mb': round(rss.peak / MB, 2),
+        'rss_growth_mb': round((rss.peak - rss.start) / MB, 2),
+    }
+
+#each case is a generator yielding (params, fn, items per call) and optionally
+#an untimed reset after doing its own setup against the stand-ins, grouped so
+#--only can pick services
+CASES = []
+
+def case(group):
+    def register(fn):
+        CASES.append((group, fn.__name__[len('bench_'):], fn))
+        return fn
+    return register
+
+@case('s3')
+def bench_read_s3_file(env):
+    s3 = lib.aws_client('s3')
+    for size in env.sizes([KB, 64 * KB, MB, 8 * MB]):
+        key = f'read/{size}.txt'
+        s3.put_object(Bucket=BUCKET, Key=key, Body=_payload(size).encode())
+        yield {'size': size}, lambda key=key: lib.read_s3_file(log, BUCKET, key, 'utf-8'), 1
+
+@case('s3')
+def bench_download_s3_parallel(env):
+    s3 = lib.aws_client('s3')
+    for size in env.sizes([MB, 16 * MB]):
+        key = f'download/{size}.bin'
+        s3.put_object(Bucket=BUCKET, Key=key, Body=os.urandom(size))
+        yield {'size': size}, lambda key=key: lib.download_s3_parallel(log, BUCKET, key), 1
+
+def _sqs_queue():
+    '''Creates the queue and returns a reset that empties it, moto slows down
+    as a queue fills up which would otherwise skew later iterations. moto
+    holds PurgeQueue to once a minute like sqs does, so the queue is recreated'''
+    sqs = lib.aws_client('sqs')
+    url = sqs.create_queue(QueueName=QUEUE)['QueueUrl']
+
+    def reset():
+        sqs.delete_queue(QueueUrl=url)
+        sqs.create_queue(QueueName=QUEUE)
+    return reset
+
+@case('sqs')
+def bench_send_sqs_message(env):
+    purge = _sqs_queue()
+    for size in env.sizes([256, 8 * KB, 64 * KB]):
+        body = _payload(size)
+        attrs = {'source': {'DataType': 'String', 'StringValue': 'bench'}}
+        yield {'size': size}, lambda body=body: lib.send_sqs_message(log, QUEUE, attrs, body, codec=False), 1, purge
+
+@case('sqs')
+def bench_sqs_producer(env):
+    purge = _sqs_queue()
+    #moto's SendMessageBatch slows down with every message already in the
+    #queue, past a few hundred messages per flush it only measures moto
+    for batch in env.sizes([10, 100]):
+        body = _payload(512)
+
+        def run(batch=batch):
+            producer = lib.SqsProducer(log, QUEUE, codec=False)
+            for _ in range(batch):
+                producer.add(body)
+            producer.flush()
+        yield {'batch': batch, 'size': 512}, run, batch, purge
+
+@case('sns')
+def bench_send_sns_message(env):
+    arn = lib.aws_client('sns').create_topic(Name='lcfs-bench')['TopicArn']
+    for size in env.sizes([KB, 64 * KB]):
+        message = json.dumps({'default': _payload(size)})
+        yield {'size': size}, lambda message=message: lib.send_sns_message(
+            log, arn, 'bench', json.loads(message), 'json', {}, codec=False), 1
+
+@case('sns')
+def bench_send_sns_batch(env):
+    arn = lib.aws_client('sns').create_topic(Name='lcfs-bench')['TopicArn']
+    for batch in env.sizes([10, 100]):
+        messages = [{'message': _payload(KB), 'subject': 'bench'} for _ in range(batch)]
+        yield {'batch': batch, 'size': KB}, lambda messages=messages: lib.send_sns_batch(
+            log, arn, messages, codec=False), batch
+
+@case('ssm')
+def bench_get_ssm_params(env):
+    ssm = lib.aws_client('ssm')
+    names = [f'/lcfs/bench/param{i}' for i in range(25)]
+    for name in names:
+        ssm.put_parameter(Name=name, Value='value ' + name, Type='SecureString', Overwrite=True)
+    for count in env.sizes([1, 10, 25]):
+        wanted = names[0] if count == 1 else names[:count]
+
+        def cold(wanted=wanted):
+            lib.invalidate_ssm_cache()
+            lib.get_ssm_params(log, wanted, True)
+        yield {'names': count, 'cached': False}, cold, count
+        yield {'names': count, 'cached': True}, lambda wanted=wanted: lib.get_ssm_params(log, wanted, True), count
+
+def _transaction(i):
+    item = {'transaction': f't{i:06d}', 'payee_invoice': f'inv{i}', 'name': f'Vendor {i % 50}',
+            'status': 'PENDING', 'amount': Decimal(i % 1000) / 4, 'payer_name': 'Bench Payer',
+            'name_on_account': f'Vendor {i % 50}', 'timestamp': '2024-01-01T00:00:00Z'}
+    item[lib.DUP_FINGERPRINT_ATTR] = lib.dup_fingerprint(item)
+    return item
+
+def _transactions_table(env):
+    if env.table_rows:
+        return
+    ddb = lib.aws_client('dynamodb')
+    ddb.create_table(TableName=TABLE, BillingMode='PAY_PER_REQUEST',
+                     KeySchema=[{'AttributeName': 'transaction', 'KeyType': 'HASH'}],
+                     AttributeDefinitions=[{'AttributeName': 'transaction', 'AttributeType': 'S'},
+                                           {'AttributeName': lib.DUP_FINGERPRINT_ATTR, 'AttributeType': 'S'},
+                                           {'AttributeName': 'status', 'AttributeType': 'S'}],
+                     GlobalSecondaryIndexes=[{'IndexName': 'fingerprint-status',
+                                              'KeySchema': [{'AttributeName': lib.DUP_FINGERPRINT_ATTR,
+                                                             'KeyType': 'HASH'},
+                                                            {'AttributeName': 'status', 'KeyType': 'RANGE'}],
+                                              'Projection': {'ProjectionType': 'ALL'}}])
+    env.table_rows = 200 if env.quick else 2000
+    lib.ddb_batch_write(TABLE, [_transaction(i) for i in range(env.table_rows)])
+
+@case('dynamodb')
+def bench_get_ddb_res(env):
+    _transactions_table(env)
+    yield {'query': 'primary_key', 'rows': env.table_rows}, lambda: lib.get_ddb_res(TABLE, {'transaction': 't000042'}), 1
+    fp = lib.dup_fingerprint(_transaction(42))
+    yield {'query': 'index', 'rows': env.table_rows}, lambda: lib.get_ddb_res(
+        TABLE, {lib.DUP_FINGERPRINT_ATTR: fp, 'status': 'PENDING'}), 1
+    yield {'query': 'scan', 'rows': env.table_rows}, lambda: lib.get_ddb_res(TABLE, {'payer_name': 'Bench Payer'}), 1
+
+@case('dynamodb')
+def bench_ddb_batch_write(env):
+    _transactions_table(env)
+    for batch in env.sizes([25, 250, 1000]):
+        items = [_transaction(100000 + i) for i in range(batch)]
+        yield {'batch': batch}, lambda items=items: lib.ddb_batch_write(TABLE, items), batch
+
+@case('dynamodb')
+def bench_find_duplicates(env):
+    _transactions_table(env)
+    for batch in env.sizes([1, 100]):
+        items = [dict(_transaction(i * 7), transaction=f'new{i}') for i in range(batch)]
+        yield {'batch': batch}, lambda items=items: lib.find_duplicates(items, TABLE), batch
+
+@case('dropbox')
+def bench_dau_copy_to(env):
+    s3 = lib.aws_client('s3')
+    dbx = FakeDropbox()
+    for size in env.sizes([64 * KB, MB, 20 * MB]):
+        key = f'copy/{size}.bin'
+        s3.put_object(Bucket=BUCKET, Key=key, Body=os.urandom(size))
+        yield {'size': size}, lambda key=key, size=size: lib.dau_copy_to(
+            log, BUCKET, key, dbx, f'/bench/{size}.bin'), 1
+
+@case('dropbox')
+def bench_dau_to_s3(env):
+    dbx = FakeDropbox()
+    for size in env.sizes([64 * KB, MB, 20 * MB]):
+        dbx.files_upload(os.urandom(size), f'/bench/{size}.bin')
+        yield {'size': size}, lambda size=size: lib.dau_to_s3(
+            log, dbx, '/bench/', f'{size}.bin', f'from-dropbox/{size}.bin', BUCKET), 1
+
+@case('dropbox')
+def bench_dau_sync_to_s3(env):
+    dbx = FakeDropbox(page_size=100)
+    for count in env.sizes([10, 200]):
+        for i in range(count):
+            dbx.files_upload(_payload(4 * KB).encode(), f'/sync{count}/d{i % 10}/f{i}.txt')
+        yield {'files': count, 'size': 4 * KB}, lambda count=count: lib.dau_sync_to_s3(
+            log, dbx, f'/sync{count}', BUCKET, f'sync{count}/'), count
+
+@case('dropbox')
+def bench_dau_create_folders(env):
+    dbx = FakeDropbox(latency=env.rtt_ms / 1000)
+    fresh = iter(range(10 ** 9))
+    for count in env.sizes([10, 500]):
+        paths = [f'/folders{count}/f{i}' for i in range(count)]
+        yield {'folders': count, 'known': False}, lambda count=count: lib.dau_create_folders(
+            log, dbx, [f'/fresh{next(fresh)}/f{i}' for i in range(count)]), count
+        yield {'folders': count, 'known': True}, lambda paths=paths: lib.dau_create_folders(log, dbx, paths), count
+
+@case('dropbox')
+def bench_dau_create_folder(env):
+    dbx = FakeDropbox(latency=env.rtt_ms / 1000)
+    session = lib.DropboxSession(client=dbx)
+    fresh = iter(range(10 ** 9))
+    yield {'known': False}, lambda: lib.dau_create_folder(log, session, '/new/', f'f{next(fresh)}'), 1
+    yield {'known': True}, lambda: lib.dau_create_folder(log, session, '/new/', 'f0'), 1
+
+@case('vault')
+def bench_get_token(env):
+    lib.disable_vault_cache()
+    yield {'op': 'tokenize'}, lambda: lib.get_token(log, env.vault_url, 'bench-key', 'secret value'), 1
+    yield {'op': 'hash'}, lambda: lib.get_hash(log, env.vault_url, 'bench-key', 'tok-abc'), 1
+    yield {'op': 'detokenize'}, lambda: lib.get_tv(log, env.vault_url, 'bench-key', 'abc123'), 1
+
+@case('vault')
+def bench_vault_bulk(env):
+    lib.disable_vault_cache()
+    client = lib.vault_client(env.vault_url, 'bench-key')
+    for batch in env.sizes([10, 100, 1000]):
+        values = [f'account {i}' for i in range(batch)]
+        yield {'batch': batch}, lambda values=values: client.bulk('tokenize', values), batch
+
+@case('ses')
+def bench_send_mail(env):
+    lib.aws_client('ses').verify_email_identity(EmailAddress=SENDER)
+    attachment = os.path.join(env.tmp, 'statement.pdf')
+    with open(attachment, 'wb') as f:
+        f.write(os.urandom(100 * KB))
+    yield {'attachments': 0}, lambda: lib.send_mail(SENDER, ['to@example.com'], 'bench', text='hello'), 1
+    yield {'attachments': 1, 'size': 100 * KB}, lambda: lib.send_mail(
+        SENDER, ['to@example.com'], 'bench', text='hello', attachments=[attachment]), 1
+
+@case('ses')
+def bench_send_bulk_mail(env):
+    lib.aws_client('ses').verify_email_identity(EmailAddress=SENDER)
+    for batch in env.sizes([10, 50]):
+        messages = [{'recipients': [f'user{i}@example.com'], 'title': 'statement', 'text': 'hello'}
+                    for i in range(batch)]
+        yield {'batch': batch}, lambda messages=messages: lib.send_bulk_mail(SENDER, messages, rate=1000), batch
+
+@case('async')
+def bench_handler_fanout(env):
+    ssm = lib.aws_client('ssm')
+    ssm.put_parameter(Name='/lcfs/bench/fanout', Value='value', Type='SecureString', Overwrite=True)
+    lib.aws_client('s3').put_object(Bucket=BUCKET, Key='fanout.txt', Body=_payload(64 * KB).encode())
+    lib.aws_client('sqs').create_queue(QueueName='lcfs-bench-fanout')
+    arn = lib.aws_client('sns').create_topic(Name='lcfs-bench')['TopicArn']
+    values = [f'account {i}' for i in range(8)]
+
+    def sequential():
+        lib.invalidate_ssm_cache()
+        lib.get_ssm_params(log, '/lcfs/bench/fanout', True)
+        for v in values:
+            lib.get_token(log, env.vault_url, 'bench-key', v)
+        lib.read_s3_file(log, BUCKET, 'fanout.txt', 'utf-8')
+        lib.send_sqs_message(log, 'lcfs-bench-fanout', {}, 'done', codec=False)
+        lib.send_sns_message(log, arn, 'bench', 'done', None, {}, codec=False)
+
+    async def gathered():
+        lib.invalidate_ssm_cache()
+        await lib.gather_limited(
+            lib.get_ssm_params_async(log, '/lcfs/bench/fanout', True),
+            *(lib.get_token_async(log, env.vault_url, 'bench-key', v) for v in values),
+            lib.read_s3_file_async(log, BUCKET, 'fanout.txt', 'utf-8'),
+            lib.send_sqs_message_async(log, 'lcfs-bench-fanout', {}, 'done', codec=False),
+            lib.send_sns_message_async(log, arn, 'bench', 'done', None, {}, codec=False))
+
+    for rtt_ms in sorted({env.default_rtt_ms, 10}):
+        env.rtt_ms = rtt_ms
+        yield {'mode': 'sequential', 'calls': len(values) + 4, 'rtt_ms': rtt_ms}, sequential, 1
+        yield {'mode': 'gathered', 'calls': len(values) + 4, 'rtt_ms': rtt_ms}, lambda: lib.run_async(gathered), 1
+    env.rtt_ms = env.default_rtt_ms
+
+class Env:
+    '''What the cases share, sizes are trimmed to the smallest two with --quick'''
+
+    def __init__(self, quick, vault, tmp, rtt_ms):
+        self.quick = quick
+        self.vault = vault
+        self.vault_url = vault.url
+        self.tmp = tmp
+        self.table_rows = 0
+        self.default_rtt_ms = rtt_ms
+        self.rtt_ms = rtt_ms
+
+    def sizes(self, values):
+        return values[:2] if self.quick else values
+
+    @property
+    def rtt_ms(self):
+        return _rtt[0] * 1000
+
+    @rtt_ms.setter
+    def rtt_ms(self, ms):
+        '''Simulated network round trip added to every aws and vault call'''
+        _rtt[0] = ms / 1000
+        self.vault.latency = ms / 1000
+
+#moto and the tokenization server answer in process, so without a simulated
+#round trip there is no network wait for concurrent calls to overlap
+_rtt = [0.0]
+
+def _simulated_rtt(**kw):
+    if _rtt[0]:
+        time.sleep(_rtt[0])
+
+def _iterations(params, base):
+    '''Fewer iterations for the large payloads and batches'''
+    scale = max(params.get('size', 0) // MB, params.get('batch', 0) // 100, params.get('files', 0) // 100, 1)
+    return max(3, base // scale)
+
+def _git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    import tempfile
+    groups = set(args.only.split(',')) if args.only else None
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, TokenizationServer() as vault, mock_aws():
+        lib.reset_aws_clients()
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register('before-call', _simulated_rtt)
+        lib.aws_client('s3').create_bucket(Bucket=BUCKET)
+        env = Env(args.quick, vault, tmp, args.rtt_ms)
+        for group, name, fn in CASES:
+            if groups and group not in groups and name not in groups:
+                continue
+            for params, call, items, *reset in fn(env):
+                stats = measure(call, _iterations(params, args.iterations), items, args.max_seconds,
+                                reset=reset[0] if reset else None)
+                row = {'case': name, 'group': group, 'params': params}
+                row.update(stats)
+                results.append(row)
+                lat = stats['latency_ms']
+                print(f"{name:<22} {json.dumps(params, sort_keys=True):<40} p50 {lat['p50']:>9.2f} ms  "
+                      f"p99 {lat['p99']:>9.2f} ms  {stats['calls_per_sec']:>8.1f}/s  "
+                      f"rss {stats['rss_peak_mb']:>7.1f} MB", flush=True)
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_rev': _git_rev(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'quick': args.quick,
+            'rtt_ms': args.rtt_ms,
+        },
+        'results': results,
+    }
+
+def compare(current, baseline_path):
+    '''Prints the p50 and throughput change of every case found in both runs'''
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    key = lambda r: (r['case'], json.dumps(r['params'], sort_keys=True))
+    before = {key(r): r for r in baseline['results']}
+    print(f"\ncompared with {baseline_path} ({baseline['meta'].get('git_rev')})")
+    for row in current['results']:
+        old = before.get(key(row))
+        if old is None:
+            continue
+        p50 = row['latency_ms']['p50'] / old['latency_ms']['p50'] - 1 if old['latency_ms']['p50'] else 0
+        cps = row['calls_per_sec'] / old['calls_per_sec'] - 1 if old['calls_per_sec'] else 0
+        print(f"{row['case']:<22} {key(row)[1]:<40} p50 {p50:>+7.1%}  calls/s {cps:>+7.1%}  "
+              f"rss {row['rss_peak_mb'] - old['rss_peak_mb']:>+7.1f} MB")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--iterations', type=int, default=30, help='calls per case, scaled down for big payloads')
+    ap.add_argument('--max-seconds', type=float, default=20, help='stop a case early once it has run this long')
+    ap.add_argument('--only', help='comma separated groups or case names ie s3,vault,read_s3_file')
+    ap.add_argument('--quick', action='store_true', help='only the two smallest sizes of each case')
+    ap.add_argument('--rtt-ms', type=float, default=0, help='simulated round trip added to every aws and vault call')
+    ap.add_argument('--json', help='write the results to this file')
+    ap.add_argument('--compare', help='a previous --json file to compare against')
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    lib.set_log_level(logging.WARNING)
+    result = run(args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(result, args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,82 +1,1065 @@
-import boto3, json, io, dropbox, urllib3,logging,os
+import json, io, logging, os, importlib
+import threading, time, hashlib, codecs, hmac, queue, random, tempfile, mmap, base64, gzip, uuid
+from collections import OrderedDict
 from urllib.error import HTTPError
 from types import MappingProxyType
-from botocore.exceptions import ClientError
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from boto3.dynamodb.conditions import Key, Attr, And
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
 import functools
 from functools import reduce
 import sys
 
+class _LazyModule:
+    '''Stands in for a module and imports it the first time an attribute is used'''
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return f'<lazy module {self.__dict__["_name"]!r} ({state})>'
+
+#boto3, dropbox, urllib3 and the email.mime stack are only imported the first
+#time a helper uses them, so a lambda that only needs SSM never pays for the
+#dropbox sdk or the mime machinery on a cold start
+boto3 = _LazyModule('boto3')
+dropbox = _LazyModule('dropbox')
+urllib3 = _LazyModule('urllib3')
+_botocore_config = _LazyModule('botocore.config')
+_botocore_exceptions = _LazyModule('botocore.exceptions')
+_ddb_conditions = _LazyModule('boto3.dynamodb.conditions')
+_ddb_transform = _LazyModule('boto3.dynamodb.transform')
+_mime_multipart = _LazyModule('email.mime.multipart')
+_mime_text = _LazyModule('email.mime.text')
+_mime_application = _LazyModule('email.mime.application')
+asyncio = _LazyModule('asyncio')
+
+#names this module used to import eagerly, still reachable as attributes
+_LAZY_NAMES = {
+    'ClientError': (_botocore_exceptions, 'ClientError'),
+    'Config': (_botocore_config, 'Config'),
+    'Key': (_ddb_conditions, 'Key'),
+    'Attr': (_ddb_conditions, 'Attr'),
+    'And': (_ddb_conditions, 'And'),
+    'MIMEMultipart': (_mime_multipart, 'MIMEMultipart'),
+    'MIMEText': (_mime_text, 'MIMEText'),
+    'MIMEApplication': (_mime_application, 'MIMEApplication'),
+}
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        module, attr = _LAZY_NAMES[name]
+        return getattr(module, attr)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+#the log level comes from LCFS_LOG_LEVEL, or the lambda's own log level
+#setting, instead of forcing DEBUG. Debug calls pass their values as %-style
+#args so payloads are only formatted when the record is actually written
+#lambda's TRACE has no logging equivalent so it maps to DEBUG, and a level
+#logging does not know falls back to INFO rather than failing the import
+_LEVEL_ALIASES = {'TRACE': 'DEBUG'}
+
+def _log_level(level):
+    '''Returns level as a number logging accepts, INFO when it is not a known level'''
+    if isinstance(level, int):
+        return level
+    name = str(level).strip().upper()
+    name = _LEVEL_ALIASES.get(name, name)
+    value = logging.getLevelName(name)
+    return value if isinstance(value, int) else logging.INFO
+
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(_log_level(os.environ.get('LCFS_LOG_LEVEL') or os.environ.get('AWS_LAMBDA_LOG_LEVEL') or 'INFO'))
+LOG_LEVEL = logging.getLevelName(logger.level)
+
+def set_log_level(level):
+    '''This function changes the level of the root logger the lambdas log through
+    :param: level=a logging level name or number ie DEBUG, 'info', logging.WARNING,
+            TRACE is treated as DEBUG and an unknown name as INFO
+    :returns: nothing
+    '''
+    global LOG_LEVEL
+    logging.getLogger().setLevel(_log_level(level))
+    LOG_LEVEL = logging.getLevelName(logging.getLogger().level)
+
+#fields whose values never make it into a log line, matched on the lower
+#cased key at any depth of a dict, list or json string
+REDACT_KEYS = frozenset(['password', 'secret', 'token', 'apikey', 'api_key', 'x-api-key', 'authorization',
+                         'plaintext', 'plaintext_item', 'plaintext_value', 'value', 'v', 'stringvalue',
+                         'binaryvalue', 'account_number', 'routing_number', 'ssn', 'tin'] +
+                        [k.strip().lower() for k in os.environ.get('LCFS_REDACT_KEYS', '').split(',') if k.strip()])
+REDACTED = '***'
+
+def redact(obj, keys=None):
+    '''This function returns a copy of obj with sensitive values masked
+    :param: obj=a dict, list, tuple or string, json strings are parsed and masked
+    :param: keys=the field names to mask, None uses REDACT_KEYS
+    :returns: the masked copy, other values come back as they are
+    '''
+    keys = REDACT_KEYS if keys is None else keys
+    if isinstance(obj, dict):
+        return {k: REDACTED if isinstance(k, str) and k.lower() in keys else redact(v, keys) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [redact(v, keys) for v in obj]
+    if isinstance(obj, (str, bytes)) and obj[:1] in ('{', '[', b'{', b'['):
+        try:
+            return json.dumps(redact(json.loads(obj), keys))
+        except ValueError:
+            return obj
+    return obj
+
+class _Redacted:
+    '''Log argument that masks its value only when the record is formatted'''
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return str(redact(self.obj))
+
+    __repr__ = __str__
+
+_redacted = _Redacted
+
+#every aws, dropbox and vault call is timed. Latency, bytes, retries and
+#errors are logged at DEBUG and, when metrics are on, aggregated per operation
+#and written to stdout as CloudWatch Embedded Metric Format, which the lambda
+#log pipeline turns into metrics without any PutMetricData calls
+METRICS_ENABLED = os.environ.get('LCFS_METRICS', '').lower() in ('1', 'true', 'yes', 'on')
+METRICS_NAMESPACE = os.environ.get('LCFS_METRICS_NAMESPACE', 'lcfsLambdaLib')
+METRICS_MAX_SAMPLES = 100
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def record_call(service, operation, elapsed, nbytes=0, retries=0, error=False):
+    '''This function records one timed call
+    :param: service=the service called ie s3, dropbox, vault
+    :param: operation=the operation ie GetObject, files/upload, tokenize
+    :param: elapsed=the call time in seconds
+    :param: nbytes=the request plus response payload size
+    :param: retries=how many times the call was retried
+    :param: error=whether the call failed
+    :returns: nothing
+    '''
+    ms = elapsed * 1000
+    logger.debug('%s %s took %.1f ms, %d bytes, %d retries%s', service, operation, ms, nbytes, retries,
+                 ' (failed)' if error else '')
+    if not METRICS_ENABLED:
+        return
+    full = None
+    with _metrics_lock:
+        m = _metrics.get((service, operation))
+        if m is None:
+            m = _metrics[(service, operation)] = {'Latency': [], 'Calls': 0, 'Bytes': 0, 'Retries': 0, 'Errors': 0}
+        m['Latency'].append(round(ms, 3))
+        m['Calls'] += 1
+        m['Bytes'] += nbytes
+        m['Retries'] += retries
+        m['Errors'] += 1 if error else 0
+        #EMF takes at most 100 values per metric so a busy operation is
+        #written out as soon as it fills up
+        if len(m['Latency']) >= METRICS_MAX_SAMPLES:
+            full = _metrics.pop((service, operation))
+    if full is not None:
+        _write_emf([((service, operation), full)])
+
+class timed_call:
+    '''Context manager that times a call and hands it to record_call. Set
+    nbytes, retries or error on it inside the block, an exception marks the
+    call failed
+    '''
+
+    def __init__(self, service, operation, nbytes=0):
+        self.service = service
+        self.operation = operation
+        self.nbytes = nbytes
+        self.retries = 0
+        self.error = False
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_call(self.service, self.operation, time.perf_counter() - self.start, self.nbytes, self.retries,
+                    self.error or exc_type is not None)
+        return False
+
+def _write_emf(entries):
+    '''Writes one EMF document per (service, operation) to stdout'''
+    now = int(time.time() * 1000)
+    out = []
+    for (service, operation), m in entries:
+        doc = {'_aws': {'Timestamp': now,
+                        'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                               'Dimensions': [['Service', 'Operation']],
+                                               'Metrics': [{'Name': 'Latency', 'Unit': 'Milliseconds'},
+                                                           {'Name': 'Calls', 'Unit': 'Count'},
+                                                           {'Name': 'Bytes', 'Unit': 'Bytes'},
+                                                           {'Name': 'Retries', 'Unit': 'Count'},
+                                                           {'Name': 'Errors', 'Unit': 'Count'}]}]},
+               'Service': service, 'Operation': operation}
+        doc.update(m)
+        out.append(json.dumps(doc))
+    if out:
+        sys.stdout.write('\n'.join(out) + '\n')
+        sys.stdout.flush()
+
+def flush_metrics():
+    '''This function writes out everything aggregated since the last flush
+    :returns: the number of EMF documents written
+    '''
+    with _metrics_lock:
+        entries = list(_metrics.items())
+        _metrics.clear()
+    _write_emf(entries)
+    return len(entries)
+
+def enable_metrics(namespace=None):
+    '''This function turns on EMF metrics for timed calls
+    :param: namespace=the CloudWatch namespace, None keeps METRICS_NAMESPACE
+    :returns: nothing
+    '''
+    global METRICS_ENABLED, METRICS_NAMESPACE
+    if namespace:
+        METRICS_NAMESPACE = namespace
+    METRICS_ENABLED = True
+
+def disable_metrics():
+    '''This function writes out what is pending and turns EMF metrics off
+    :returns: nothing
+    '''
+    global METRICS_ENABLED
+    flush_metrics()
+    METRICS_ENABLED = False
+
+def metrics_autoflush(handler):
+    '''Decorator for a lambda handler that writes out the call metrics when
+    the handler returns or raises
+    '''
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush_metrics()
+    return wrapper
+
+def _body_size(body):
+    '''Size of a request body, bytes or a seekable file like s3 uploads send'''
+    if not body:
+        return 0
+    if hasattr(body, '__len__'):
+        return len(body)
+    try:
+        pos = body.tell()
+        end = body.seek(0, 2)
+        body.seek(pos)
+        return end - pos
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+def _aws_before_call(model, params, context, **kw):
+    '''botocore hook, notes the start time and request size of a call'''
+    context['lcfs_call'] = (model.service_model.service_name, model.name, time.perf_counter(),
+                            _body_size(params.get('body')))
+
+def _aws_after_call(http_response, parsed, context, **kw):
+    '''botocore hook, records the call once the response is parsed'''
+    call = context.pop('lcfs_call', None)
+    if call is None:
+        return
+    service, operation, start, nbytes = call
+    meta = parsed.get('ResponseMetadata', {}) if isinstance(parsed, dict) else {}
+    try:
+        nbytes += int(meta.get('HTTPHeaders', {}).get('content-length') or 0)
+    except ValueError:
+        pass
+    record_call(service, operation, time.perf_counter() - start, nbytes, meta.get('RetryAttempts', 0),
+                http_response.status_code >= 300)
+
+def _aws_after_call_error(exception, context, **kw):
+    '''botocore hook, records a call that never got a response'''
+    call = context.pop('lcfs_call', None)
+    if call is not None:
+        service, operation, start, nbytes = call
+        record_call(service, operation, time.perf_counter() - start, nbytes, 0, True)
+
+def _instrument_aws(client):
+    '''Registers the timing hooks on a botocore client'''
+    events = client.meta.events
+    events.register('before-call', _aws_before_call, unique_id='lcfs-before-call')
+    events.register('after-call', _aws_after_call, unique_id='lcfs-after-call')
+    events.register('after-call-error', _aws_after_call_error, unique_id='lcfs-after-call-error')
+    return client
+
+def instrument_dropbox(dbx):
+    '''This function times every api call a Dropbox client makes, the dau
+    helpers call it on the client they are given
+    :param: dbx=the Dropbox client
+    :returns: the same client
+    '''
+    request = getattr(dbx, 'request', None)
+    if request is None or getattr(request, '_lcfs_timed', False):
+        return dbx
+
+    def timed(route, namespace, request_arg, request_binary, *args, **kw):
+        operation = route.name if route.version < 2 else f'{route.name}_v{route.version}'
+        with timed_call('dropbox', operation, len(request_binary) if request_binary else 0) as call:
+            res = request(route, namespace, request_arg, request_binary, *args, **kw)
+            if isinstance(res, tuple) and len(res) == 2 and hasattr(res[1], 'headers'):
+                call.nbytes += int(res[1].headers.get('content-length') or 0)
+            return res
+    timed._lcfs_timed = True
+    dbx.request = timed
+    return dbx
 
 '''This file contains code reused in all our lambdas'''
 
+#boto3 clients are expensive to build (endpoint resolution, credential lookup,
+#a new connection pool) so we keep them at module level where they survive
+#across warm invocations of the lambda
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('LCFS_AWS_MAX_POOL_CONNECTIONS', '10'))
+_aws_registry = {}
+_aws_lock = threading.RLock()
+#resources are kept per thread in a threading.local so they go away with the
+#thread, the generation lets reset_aws_clients drop every thread's copy
+_aws_local = threading.local()
+_aws_generation = 0
+
+def _aws_key(kind, service, region, config_kw):
+    '''Builds the registry key for a client or resource'''
+    return (kind, service, region, tuple(sorted((k, repr(v)) for k, v in config_kw.items())))
+
+def _aws_config(config_kw):
+    '''Builds the botocore Config, defaulting the connection pool size'''
+    kw = dict(config_kw)
+    kw.setdefault('max_pool_connections', AWS_MAX_POOL_CONNECTIONS)
+    return _botocore_config.Config(**kw)
+
+def aws_client(service, region=None, **config_kw):
+    '''This function returns a cached boto3 client for a service
+    boto3 clients are thread safe so one client is shared by every thread
+    :param: service=the aws service name ie ssm, sqs, s3
+    :param: region=the aws region, None uses the lambda's region
+    :param: config_kw=botocore Config options ie max_pool_connections, retries
+    :returns: the boto3 client
+    '''
+    key = _aws_key('client', service, region, config_kw)
+    client = _aws_registry.get(key)
+    if client is None:
+        with _aws_lock:
+            client = _aws_registry.get(key)
+            if client is None:
+                client = _instrument_aws(boto3.client(service, region_name=region, config=_aws_config(config_kw)))
+                _aws_registry[key] = client
+    return client
+
+def aws_resource(service, region=None, **config_kw):
+    '''This function returns a cached boto3 resource for a service
+    boto3 resources are not thread safe so each thread gets its own, kept in a
+    threading.local so it goes away with the thread
+    :param: service=the aws service name ie dynamodb
+    :param: region=the aws region, None uses the lambda's region
+    :param: config_kw=botocore Config options ie max_pool_connections, retries
+    :returns: the boto3 resource
+    '''
+    key = _aws_key('resource', service, region, config_kw)
+    if getattr(_aws_local, 'generation', None) != _aws_generation:
+        _aws_local.resources = {}
+        _aws_local.generation = _aws_generation
+    res = _aws_local.resources.get(key)
+    if res is None:
+        res = boto3.resource(service, region_name=region, config=_aws_config(config_kw))
+        _instrument_aws(res.meta.client)
+        _aws_local.resources[key] = res
+    return res
+
+def prewarm_aws_clients(services, region=None):
+    '''This function builds clients ahead of time, call it at init time so the
+    cost lands in the lambda init phase instead of the first invocation
+    :param: services=a list or comma separated string of service names
+    :param: region=the aws region, None uses the lambda's region
+    :returns: nothing
+    '''
+    if isinstance(services, str):
+        services = [s.strip() for s in services.split(',') if s.strip()]
+    for service in services:
+        aws_client(service, region)
+
+def set_aws_pool_size(size):
+    '''This function changes the connection pool size used for new clients
+    and drops the cached ones so they get rebuilt with it
+    :param: size=the max_pool_connections for each client
+    :returns: nothing
+    '''
+    global AWS_MAX_POOL_CONNECTIONS
+    AWS_MAX_POOL_CONNECTIONS = int(size)
+    reset_aws_clients()
+
+def reset_aws_clients():
+    '''This function drops every cached client and resource, used by tests
+    and when credentials or config need to be picked up again
+    :returns: nothing
+    '''
+    global _aws_generation
+    with _aws_lock:
+        _aws_registry.clear()
+        _aws_generation += 1
+
+if os.environ.get('LCFS_AWS_PREWARM'):
+    prewarm_aws_clients(os.environ['LCFS_AWS_PREWARM'])
+
+#SSM values are cached in process with a per entry TTL so warm invocations do
+#not refetch (and get throttled on) parameters that rarely change
+SSM_CACHE_TTL = float(os.environ.get('LCFS_SSM_CACHE_TTL', '300'))
+SSM_BATCH_SIZE = 10
+_ssm_cache = {}
+_ssm_path_cache = {}
+_ssm_lock = threading.Lock()
+_ssm_refresher = None
+
+def _ssm_store(values, enc, ttl):
+    '''Puts fetched values in the cache, a ttl of 0 or less disables caching'''
+    if ttl <= 0:
+        return
+    expires = time.monotonic() + ttl
+    with _ssm_lock:
+        for name, value in values.items():
+            _ssm_cache[(name, bool(enc))] = (value, expires, ttl)
+
+#GetParameters is a separate IAM action from GetParameter, roles that only
+#grant ssm:GetParameter are remembered and get the per name calls
+_ssm_batch_denied = False
+
+def _ssm_fetch(logger, names, enc, ttl):
+    '''Pulls names from SSM with GetParameters in chunks of 10, or one at a
+    time with GetParameter when the role may not call GetParameters'''
+    global _ssm_batch_denied
+    ssm_client = aws_client('ssm')
+    out = {}
+    for i in range(0, len(names), SSM_BATCH_SIZE):
+        chunk = names[i:i + SSM_BATCH_SIZE]
+        resp = None
+        if not _ssm_batch_denied:
+            try:
+                resp = ssm_client.get_parameters(Names=chunk, WithDecryption=enc)
+            except _botocore_exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'AccessDeniedException':
+                    raise
+                logger.info('No ssm:GetParameters, pulling parameters one at a time')
+                _ssm_batch_denied = True
+        if resp is None:
+            for name in chunk:
+                out[name] = ssm_client.get_parameter(Name=name, WithDecryption=enc)['Parameter']['Value']
+            continue
+        found = {}
+        for p in resp['Parameters']:
+            found[p['Name']] = p['Value']
+            found[p.get('ARN')] = p['Value']
+            if p.get('Selector'):
+                found[f"{p['Name']}{p['Selector']}"] = p['Value']
+        for name in chunk:
+            if name in found:
+                out[name] = found[name]
+            else:
+                #pull it on its own so a missing name raises ParameterNotFound like before
+                logger.debug('Parameter %s not in batch response, pulling it singly', name)
+                out[name] = ssm_client.get_parameter(Name=name, WithDecryption=enc)['Parameter']['Value']
+    _ssm_store(out, enc, ttl)
+    return out
+
+def ssm_get_parameters(logger, names, enc, ttl=None):
+    '''This function pulls parameters from SSM through the in process cache
+    Anything missing or expired is fetched with GetParameters, 10 names per call
+    :param: logger=the logging handle
+    :param: names=a list or string of parameter names
+    :param: enc=either true or false depending on if encryption is used
+    :param: ttl=seconds to cache the values, None uses SSM_CACHE_TTL
+    :returns: a dict of name to raw value in the order asked for
+    '''
+    if isinstance(names, str):
+        names = [names]
+    ttl = SSM_CACHE_TTL if ttl is None else ttl
+    now = time.monotonic()
+    out = {}
+    missing = []
+    with _ssm_lock:
+        for name in names:
+            entry = _ssm_cache.get((name, bool(enc)))
+            if entry and entry[1] > now:
+                out[name] = entry[0]
+            elif name not in missing:
+                missing.append(name)
+    logger.debug('SSM cache hits: %s misses: %s', len(out), len(missing))
+    if missing:
+        out.update(_ssm_fetch(logger, missing, enc, ttl))
+    return {name: out[name] for name in names}
+
+def get_ssm_params_by_path(logger, path, enc, recursive=True, ttl=None):
+    '''This function pulls a whole SSM hierarchy with GetParametersByPath
+    :param: logger=the logging handle
+    :param: path=the hierarchy to pull ie /billpay/prod/
+    :param: enc=either true or false depending on if encryption is used
+    :param: recursive=pull every level below path, not just the first
+    :param: ttl=seconds to cache the values, None uses SSM_CACHE_TTL
+    :returns: a read only dict of parameter name to value
+    '''
+    ttl = SSM_CACHE_TTL if ttl is None else ttl
+    key = (path, bool(enc), recursive)
+    with _ssm_lock:
+        entry = _ssm_path_cache.get(key)
+    if entry and entry[1] > time.monotonic():
+        logger.debug('SSM path %s served from cache', path)
+        return entry[0]
+    a = {}
+    paginator = aws_client('ssm').get_paginator('get_parameters_by_path')
+    for page in paginator.paginate(Path=path, Recursive=recursive, WithDecryption=enc):
+        for p in page['Parameters']:
+            a[p['Name']] = p['Value']
+    logger.debug('Pulled %s parameter(s) under %s', len(a), path)
+    _ssm_store(a, enc, ttl)
+    frozen_dict = MappingProxyType({k: v.rstrip() for k, v in a.items()})
+    if ttl > 0:
+        with _ssm_lock:
+            _ssm_path_cache[key] = (frozen_dict, time.monotonic() + ttl)
+    return frozen_dict
+
+def invalidate_ssm_cache(names=None):
+    '''This function drops cached SSM values
+    :param: names=a list or string of parameter names, None drops everything
+    :returns: nothing
+    '''
+    with _ssm_lock:
+        if names is None:
+            _ssm_cache.clear()
+            _ssm_path_cache.clear()
+            return
+        if isinstance(names, str):
+            names = [names]
+        for name in names:
+            _ssm_cache.pop((name, True), None)
+            _ssm_cache.pop((name, False), None)
+            for key in [k for k in _ssm_path_cache if name.startswith(k[0])]:
+                del _ssm_path_cache[key]
+
+def _ssm_refresh_loop(logger, interval):
+    '''Refetches cached values that will expire before the next pass'''
+    while True:
+        time.sleep(interval)
+        horizon = time.monotonic() + interval
+        with _ssm_lock:
+            due = [(k, e[2]) for k, e in _ssm_cache.items() if e[1] <= horizon]
+        for enc in (True, False):
+            by_ttl = {}
+            for (name, e), ttl in due:
+                if e == enc:
+                    by_ttl.setdefault(ttl, []).append(name)
+            for ttl, names in by_ttl.items():
+                try:
+                    _ssm_fetch(logger, names, enc, ttl)
+                except Exception as e:
+                    logger.info(f'SSM background refresh failed: {e}')
+
+def start_ssm_refresher(logger, interval=60):
+    '''This function starts a daemon thread that refreshes cached SSM values
+    before they expire so callers never wait on SSM for a warm value
+    :param: logger=the logging handle
+    :param: interval=seconds between refresh passes
+    :returns: the refresher thread
+    '''
+    global _ssm_refresher
+    with _ssm_lock:
+        if _ssm_refresher is None or not _ssm_refresher.is_alive():
+            _ssm_refresher = threading.Thread(target=_ssm_refresh_loop, args=(logger, interval),
+                                              name='lcfs-ssm-refresh', daemon=True)
+            _ssm_refresher.start()
+    return _ssm_refresher
+
 def get_ssm_params(logger,path,enc):
     '''This function will pull a parameter from SSM
     Path is either a list or a string for a single return
     :params path=a list or string of the variable path
     :params enc=either true or false depending on if encryption is used
     '''
-    logger.debug(f'Starting parameter pull')
-    logger.debug(f'Getting parameter(s) {path} with encryption set to {enc}')
-    a = {}
-    ssm_client = boto3.client('ssm')
-    if isinstance(path, str):
-        param1 = ssm_client.get_parameter(Name=path, WithDecryption=enc)
-        a[path] = param1['Parameter']['Value'].rstrip()
-        logger.debug(f'Sucessfully pulled {a[path]} from {path}')
-    else:
-        for i in path:
-            logger.debug(f'Lookup: {i}')
-            param1 = ssm_client.get_parameter(Name=i, WithDecryption=enc)
-            logger.debug(f'Sucessfully pulled value from {i}')
-            a[i] = param1['Parameter']['Value'].rstrip()
-    logger.debug(f'SSM parameter(s) done')
+    logger.debug('Starting parameter pull')
+    logger.debug('Getting parameter(s) %s with encryption set to %s', path, enc)
+    a = {k: v.rstrip() for k, v in ssm_get_parameters(logger, path, enc).items()}
+    logger.debug('SSM parameter(s) done')
 
     frozen_dict = MappingProxyType(a)
     return frozen_dict
 
-def send_sqs_message(logger,sqs_queue_name, msg_att, msg_body):
+#message bodies can be compressed once they pass a threshold and parked in s3
+#once they pass the 256 KB hard limit, with a small pointer sent in their
+#place. The lcfs_codec message attribute records what was done so
+#decode_message can undo it on the consumer side
+CODEC_ATTR = 'lcfs_codec'
+MSG_MAX_BYTES = 262144
+MSG_COMPRESS_THRESHOLD = int(os.environ.get('LCFS_MSG_COMPRESS_THRESHOLD', '8192'))
+CLAIM_CHECK_BUCKET = os.environ.get('LCFS_CLAIM_CHECK_BUCKET')
+CLAIM_CHECK_PREFIX = os.environ.get('LCFS_CLAIM_CHECK_PREFIX', 'claim-check/')
+
+def _zstd():
+    '''Imports zstandard, which is only needed when zstd is asked for'''
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd message compression needs the zstandard package') from None
+    return zstandard
+
+def _compress(compression, data):
+    if compression == 'gzip':
+        #mtime=0 keeps the output the same for the same body, fifo content
+        #based dedup hashes the encoded body
+        return gzip.compress(data, mtime=0)
+    if compression == 'zstd':
+        return _zstd().ZstdCompressor().compress(data)
+    raise ValueError(f'Unknown compression {compression}')
+
+def _decompress(compression, data):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(data)
+    raise ValueError(f'Unknown compression {compression}')
+
+class MessageCodec:
+    '''Encodes SQS and SNS message bodies for the wire
+    Bodies past threshold bytes are compressed and base64 encoded, when that
+    makes them smaller. Bodies that are still over the size limit are written
+    to s3 and replaced with a json pointer to the object
+    '''
+
+    def __init__(self, compression='gzip', threshold=None, claim_bucket=None, claim_prefix=None,
+                 max_bytes=MSG_MAX_BYTES):
+        self.compression = compression
+        self.threshold = MSG_COMPRESS_THRESHOLD if threshold is None else threshold
+        self.claim_bucket = claim_bucket or CLAIM_CHECK_BUCKET
+        self.claim_prefix = CLAIM_CHECK_PREFIX if claim_prefix is None else claim_prefix
+        self.max_bytes = max_bytes
+
+    def encode(self, logger, body, msg_att=None):
+        '''Encodes one message, non string bodies are json encoded once
+        :param: logger=the logging handle
+        :param: body=the message body
+        :param: msg_att=the message attributes, SQS/SNS publish format
+        :returns: the body to send and the attributes with the codec attribute added
+        '''
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        attrs = dict(msg_att or {})
+        raw = body.encode()
+        size = len(raw)
+        codec = None
+        packed = None
+        if self.compression and size > self.threshold:
+            packed = _compress(self.compression, raw)
+            if len(packed) * 4 // 3 + 4 < size:
+                body = base64.b64encode(packed).decode('ascii')
+                size = len(body)
+                codec = self.compression
+            else:
+                packed = None
+        limit = self.max_bytes - _msg_attr_size(attrs) - len(CODEC_ATTR) - 32
+        if size > limit:
+            if not self.claim_bucket:
+                raise ValueError(f'Message of {size} bytes is over the {limit} byte limit '
+                                 f'and no claim check bucket is set')
+            key = f'{self.claim_prefix}{uuid.uuid4()}'
+            aws_client('s3').put_object(Bucket=self.claim_bucket, Key=key,
+                                        Body=packed if packed is not None else raw)
+            logger.debug('Moved %s byte message body to s3://%s/%s', size, self.claim_bucket, key)
+            body = json.dumps({'s3_bucket': self.claim_bucket, 's3_key': key})
+            codec = f's3+{codec}' if codec else 's3'
+        if codec:
+            attrs[CODEC_ATTR] = {'DataType': 'String', 'StringValue': codec}
+        return body, attrs
+
+_message_codec = MessageCodec(os.environ['LCFS_MSG_CODEC']) if os.environ.get('LCFS_MSG_CODEC') else None
+
+def set_message_codec(codec):
+    '''This function sets the codec the send helpers use when none is passed
+    :param: codec=a MessageCodec, or None to send bodies as is
+    :returns: nothing
+    '''
+    global _message_codec
+    _message_codec = codec
+
+def _resolve_codec(codec):
+    '''None means the module default, False means no codec'''
+    if codec is None:
+        return _message_codec
+    return codec or None
+
+def _attr_value(msg_att, name):
+    '''Reads a string attribute in publish, SQS event or SNS event format'''
+    v = (msg_att or {}).get(name)
+    if not v:
+        return None
+    if isinstance(v, str):
+        return v
+    return v.get('StringValue') or v.get('stringValue') or v.get('Value')
+
+def decode_message(logger, body, msg_att):
+    '''This function restores a message body sent through a MessageCodec,
+    bodies without the codec attribute come back untouched
+    :param: logger=the logging handle
+    :param: body=the message body as received
+    :param: msg_att=the message attributes as received, from an SQS record,
+        an SNS envelope or a receive_message response
+    :returns: the original message body string
+    '''
+    codec = _attr_value(msg_att, CODEC_ATTR)
+    if not codec:
+        return body
+    if codec.startswith('s3'):
+        pointer = json.loads(body)
+        logger.debug('Fetching message body from s3://%s/%s', pointer["s3_bucket"], pointer["s3_key"])
+        data = aws_client('s3').get_object(Bucket=pointer['s3_bucket'], Key=pointer['s3_key'])['Body'].read()
+        compression = codec[3:] or None
+    else:
+        data = base64.b64decode(body)
+        compression = codec
+    if compression:
+        data = _decompress(compression, data)
+    return data.decode()
+
+#queue urls never change for a given name so they are looked up once per container
+_sqs_url_cache = {}
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 262144
+_sqs_producers = {}
+_sqs_producers_lock = threading.Lock()
+
+def get_sqs_queue_url(logger, sqs_queue_name):
+    '''This function returns the queue url for a queue name, cached
+    :param: logger=the logging handle
+    :param: sqs_queue_name=the name of the queue
+    :returns: the queue url
+    '''
+    url = _sqs_url_cache.get(sqs_queue_name)
+    if url is None:
+        url = aws_client('sqs').get_queue_url(QueueName=sqs_queue_name)['QueueUrl']
+        _sqs_url_cache[sqs_queue_name] = url
+        logger.debug('Cached SQS url %s for %s', url, sqs_queue_name)
+    return url
+
+def _msg_attr_size(msg_att):
+    '''Returns the bytes the message attributes count against the 256 KB limit'''
+    size = 0
+    for name, v in (msg_att or {}).items():
+        size += len(name.encode()) + len(v.get('DataType', '').encode())
+        if 'StringValue' in v:
+            size += len(v['StringValue'].encode())
+        if 'BinaryValue' in v:
+            size += len(v['BinaryValue'])
+    return size
+
+def _pack_batches(sized_entries, max_entries, max_bytes):
+    '''Groups (entry, size) pairs into batches under both the count and byte limits'''
+    batch, batch_bytes = [], 0
+    for entry, size in sized_entries:
+        if batch and (len(batch) == max_entries or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def _send_batch_with_retry(logger, send, batch, max_retries, backoff):
+    '''Calls send with a batch of entries that each carry an Id and resends
+    only the entries that failed without a sender fault. A botocore transport
+    error fails the whole batch the same way a server side error does, so
+    every entry always ends up in one of the two lists
+    :returns: the Successful and Failed entries, failures carry their Entry
+    '''
+    to_send = {e['Id']: e for e in batch}
+    ok, failed = [], []
+    for attempt in range(max_retries + 1):
+        try:
+            resp = send(list(to_send.values()))
+            ok.extend(resp.get('Successful', []))
+            errors = {f['Id']: f for f in resp.get('Failed', [])}
+        except _botocore_exceptions.ClientError as e:
+            logger.debug('Got error: %s', e)
+            err = e.response['Error']
+            errors = {i: {'Id': i, 'Code': err.get('Code'), 'Message': err.get('Message'),
+                          'SenderFault': False} for i in to_send}
+        except _botocore_exceptions.BotoCoreError as e:
+            logger.debug('Got error: %s', e)
+            #a request botocore refused to build will not get better on a resend
+            fault = isinstance(e, _botocore_exceptions.ParamValidationError)
+            errors = {i: {'Id': i, 'Code': type(e).__name__, 'Message': str(e),
+                          'SenderFault': fault} for i in to_send}
+        retry = {}
+        for i, f in errors.items():
+            if f.get('SenderFault') or attempt == max_retries:
+                failed.append(dict(f, Entry=to_send[i]))
+            else:
+                retry[i] = to_send[i]
+        if not retry:
+            break
+        logger.debug('Retrying %s failed batch entr(ies)', len(retry))
+        time.sleep(backoff * (2 ** attempt))
+        to_send = retry
+    return ok, failed
+
+class SqsProducer:
+    '''Buffers messages for one queue and sends them with send_message_batch
+    Batches are packed up to 10 entries and 256 KB. Entries that fail with a
+    server side error are retried on their own with backoff, entries the
+    sender got wrong are reported straight away. Queues whose name ends in
+    .fifo get a MessageGroupId on every entry and a MessageDeduplicationId
+    taken from the sha256 of the body when one is not passed in. Bodies go
+    through codec, or the module default codec, before they are buffered
+    '''
+
+    def __init__(self, logger, sqs_queue_name, max_retries=3, backoff=0.1, codec=None):
+        self.logger = logger
+        self.sqs_queue_name = sqs_queue_name
+        self.codec = codec
+        self.fifo = sqs_queue_name.endswith('.fifo')
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._pending = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def add(self, msg_body, msg_att=None, gid=None, dedup_id=None):
+        '''Buffers a message, non string bodies are json encoded
+        :param: msg_body=the message body
+        :param: msg_att=the SQS message attributes
+        :param: gid=the MessageGroupId, FIFO queues only
+        :param: dedup_id=the MessageDeduplicationId, FIFO queues only
+        :returns: the Id the message will have in the flush results
+        '''
+        if not isinstance(msg_body, str):
+            msg_body = json.dumps(msg_body)
+        entry = {}
+        if self.fifo:
+            entry['MessageGroupId'] = gid or 'default'
+            entry['MessageDeduplicationId'] = dedup_id or hashlib.sha256(msg_body.encode()).hexdigest()
+        codec = _resolve_codec(self.codec)
+        if codec is not None:
+            msg_body, msg_att = codec.encode(self.logger, msg_body, msg_att)
+        entry['MessageBody'] = msg_body
+        if msg_att:
+            entry['MessageAttributes'] = msg_att
+        with self._lock:
+            entry['Id'] = str(self._seq)
+            self._seq += 1
+            self._pending.append(entry)
+        return entry['Id']
+
+    def flush(self):
+        '''Sends everything buffered
+        :returns: a dict with the Successful and Failed entries, keyed by the
+            Id add() returned
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, []
+        result = {'Successful': [], 'Failed': []}
+        if not pending:
+            return result
+        sent = 0
+        try:
+            url = get_sqs_queue_url(self.logger, self.sqs_queue_name)
+            sized = ((e, len(e['MessageBody'].encode()) + _msg_attr_size(e.get('MessageAttributes'))) for e in pending)
+            for batch in _pack_batches(sized, SQS_BATCH_MAX_ENTRIES, SQS_BATCH_MAX_BYTES):
+                ok, failed = self._send_batch(url, batch)
+                result['Successful'].extend(ok)
+                result['Failed'].extend(failed)
+                sent += len(batch)
+        except Exception:
+            #batches are packed in order, so whatever was not sent goes back
+            #to the front of the buffer for the next flush
+            with self._lock:
+                self._pending[:0] = pending[sent:]
+            self.logger.info(f'Flush to {self.sqs_queue_name} stopped, {len(pending) - sent} message(s) kept for the next flush')
+            raise
+        self.logger.info(f'Flushed {len(pending)} message(s) to {self.sqs_queue_name}: '
+                         f'{len(result["Successful"])} sent, {len(result["Failed"])} failed')
+        return result
+
+    def _send_batch(self, url, batch):
+        '''Sends one batch, retrying only the entries that failed'''
+        sqs_client = aws_client('sqs')
+        return _send_batch_with_retry(
+            self.logger, lambda entries: sqs_client.send_message_batch(QueueUrl=url, Entries=entries),
+            batch, self.max_retries, self.backoff)
+
+def sqs_producer(logger, sqs_queue_name, **kw):
+    '''This function returns the shared producer for a queue, these are the
+    producers flush_sqs_producers and sqs_autoflush send at the end of a handler
+    :param: logger=the logging handle
+    :param: sqs_queue_name=the name of the queue
+    :param: kw=SqsProducer options used the first time the producer is built
+    :returns: the SqsProducer
+    '''
+    with _sqs_producers_lock:
+        producer = _sqs_producers.get(sqs_queue_name)
+        if producer is None:
+            producer = SqsProducer(logger, sqs_queue_name, **kw)
+            _sqs_producers[sqs_queue_name] = producer
+        producer.logger = logger
+    return producer
+
+def flush_sqs_producers():
+    '''This function flushes every shared producer
+    :returns: a dict of queue name to that producer's flush results
+    '''
+    with _sqs_producers_lock:
+        producers = list(_sqs_producers.values())
+    return {p.sqs_queue_name: p.flush() for p in producers}
+
+def sqs_autoflush(handler):
+    '''Decorator for a lambda handler that flushes the shared producers when
+    the handler returns or raises
+    '''
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush_sqs_producers()
+    return wrapper
+
+#consumer side of SQS. Records of a batch run concurrently, records that share
+#a FIFO MessageGroupId run in order on one worker, and only the records that
+#failed or never ran are handed back for redelivery
+SQS_CONSUMER_WORKERS = int(os.environ.get('LCFS_SQS_CONSUMER_WORKERS', '8'))
+SQS_DEADLINE_MARGIN = float(os.environ.get('LCFS_SQS_DEADLINE_MARGIN', '5'))
+
+def process_sqs_batch(logger, event, context, handler, max_workers=None, deadline_margin=None, json_body=False):
+    '''This function runs an SQS triggered lambda's records through handler and
+    builds the partial batch response, so turn on ReportBatchItemFailures on
+    the event source mapping. Bodies are decoded the way send_sqs_message and
+    send_sqs_fifo_message encoded them. When a FIFO record fails, the rest of
+    its group is failed with it so the group stays in order. Once the lambda
+    is deadline_margin seconds from its timeout no new record is started and
+    the ones not yet started are failed too, records already running are
+    waited for, which is what the margin is for, so a record is never both
+    processed and handed back for redelivery
+    :param: logger=the logging handle
+    :param: event=the lambda event
+    :param: context=the lambda context, None means no deadline
+    :param: handler=called as handler(body, attrs, record) for each record,
+        attrs is a dict of attribute name to value, raising fails the record
+    :param: max_workers=records in flight, None uses SQS_CONSUMER_WORKERS
+    :param: deadline_margin=seconds kept back from the timeout, None uses SQS_DEADLINE_MARGIN
+    :param: json_body=json decode the body before calling handler
+    :returns: the {'batchItemFailures': [...]} response for the lambda to return
+    '''
+    records = event.get('Records', [])
+    margin = SQS_DEADLINE_MARGIN if deadline_margin is None else deadline_margin
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - margin
+    groups = OrderedDict()
+    for rec in records:
+        gid = rec.get('attributes', {}).get('MessageGroupId')
+        groups.setdefault(gid if gid is not None else rec['messageId'], []).append(rec)
+    done = set()
+    lock = threading.Lock()
+
+    def run(recs):
+        for rec in recs:
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            msg_att = rec.get('messageAttributes') or {}
+            try:
+                body = decode_message(logger, rec['body'], msg_att)
+                if json_body:
+                    body = json.loads(body)
+                attrs = {k: _attr_value(msg_att, k) or (v.get('binaryValue') if isinstance(v, dict) else v)
+                         for k, v in msg_att.items() if k != CODEC_ATTR}
+                handler(body, attrs, rec)
+            except Exception as e:
+                logger.info(f'Record {rec["messageId"]} failed: {e}')
+                return
+            with lock:
+                done.add(rec['messageId'])
+
+    if groups:
+        ex = ThreadPoolExecutor(max_workers=max(1, min(max_workers or SQS_CONSUMER_WORKERS, len(groups))))
+        futures = [ex.submit(run, recs) for recs in groups.values()]
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        _, pending = wait(futures, timeout=timeout)
+        #groups that never got a worker are dropped, running ones stop at
+        #their next record and the record in hand is allowed to finish
+        for f in pending:
+            f.cancel()
+        ex.shutdown(wait=True)
+    with lock:
+        failures = [{'itemIdentifier': rec['messageId']} for rec in records if rec['messageId'] not in done]
+    logger.info(f'Processed {len(records) - len(failures)} of {len(records)} record(s)')
+    return {'batchItemFailures': failures}
+
+def send_sqs_message(logger,sqs_queue_name, msg_att, msg_body, codec=None):
     """
     This function creates our SQS message
     :param sqs_queue_name: Name of existing SQS URL
     :param masg_att: String message attributes
     :param msg_body: String message body
+    :param codec: MessageCodec for the body, None uses the module default, False sends it as is
     :return: Dictionary containing information about the sent message. If
         error, returns None.
     """
 
     # Send the SQS message
     #sqs_client = boto3.client('sqs')
-    logger.debug(f'In send_sqs_message')
+    logger.debug('In send_sqs_message')
  
-    sqs_client = boto3.client('sqs')
-    sqs_queue_url = sqs_client.get_queue_url(
-                    QueueName=sqs_queue_name)['QueueUrl'] 
-    logger.debug(f'Our SQS url: {sqs_queue_url}')
-    logger.debug(f'Our msgAttributes: {msg_att}')
-    logger.debug(f'Our Body: {msg_body}')
+    sqs_client = aws_client('sqs')
+    sqs_queue_url = get_sqs_queue_url(logger, sqs_queue_name)
+    logger.debug('Our SQS url: %s', sqs_queue_url)
+    logger.debug('Our msgAttributes: %s', _redacted(msg_att))
+    logger.debug('Our Body: %s', _redacted(msg_body))
+    codec = _resolve_codec(codec)
+    if codec is not None:
+        msg_body, msg_att = codec.encode(logger, msg_body, msg_att)
     try:
         msg = sqs_client.send_message(QueueUrl=sqs_queue_url,
                                       MessageAttributes=msg_att,
                                       MessageBody=msg_body)
-    except ClientError as e:
-        logger.debug(f'Got error: {e}')
+    except _botocore_exceptions.ClientError as e:
+        logger.debug('Got error: %s', e)
         logger.error(e) 
         return None
     return msg
 
-def send_sqs_fifo_message(logger,sqs_queue_name, msg_att,msg_body,gid):
+def send_sqs_fifo_message(logger,sqs_queue_name, msg_att,msg_body,gid,codec=None):
     """
     This function creates our SQS message
     :param sqs_queue_name: Name of existing SQS URL
     :param masg_att: String message attributes
     :param msg_body: String message body
+    :param codec: MessageCodec for the body, None uses the module default, False sends it as is
     :return: Dictionary containing information about the sent message. If
         error, returns None.
     """
@@ -84,21 +1067,43 @@ def send_sqs_fifo_message(logger,sqs_queue_name, msg_att,msg_body,gid):
     # Send the SQS message
     #sqs_client = boto3.client('sqs')
     logger.debug(type(msg_att))   
-    sqs_client = boto3.client('sqs')
-    sqs_queue_url = sqs_client.get_queue_url(
-                    QueueName=sqs_queue_name)['QueueUrl'] 
+    sqs_client = aws_client('sqs')
+    sqs_queue_url = get_sqs_queue_url(logger, sqs_queue_name)
     logger.debug(sqs_queue_url)
+    msg_body = json.dumps(msg_body)
+    #dedup on the body as given, the encoded one differs between sends once
+    #it is claim-checked
+    dedup_id = hashlib.sha256(msg_body.encode()).hexdigest()
+    codec = _resolve_codec(codec)
+    if codec is not None:
+        msg_body, msg_att = codec.encode(logger, msg_body, msg_att)
     try:
         msg = sqs_client.send_message(QueueUrl=sqs_queue_url,
                                       MessageAttributes=msg_att,
-                                      MessageBody=json.dumps(msg_body),
-                                      MessageGroupId=gid)
-    except ClientError as e:
+                                      MessageBody=msg_body,
+                                      MessageGroupId=gid,
+                                      MessageDeduplicationId=dedup_id)
+    except _botocore_exceptions.ClientError as e:
         logger.error(e) 
         return None
     return msg
 
-def send_sns_message(logger,topic_arn,subject,message,m_struct,m_attr):
+SNS_BATCH_MAX_ENTRIES = 10
+SNS_BATCH_MAX_BYTES = 262144
+SNS_PUBLISH_WORKERS = int(os.environ.get('LCFS_SNS_PUBLISH_WORKERS', '4'))
+
+def _sns_encode(message, m_struct):
+    '''Serializes a message for publish in a single pass
+    A json structure that only has a default key is delivered by SNS exactly
+    like a plain message holding that default string, so we send it plain
+    and skip wrapping it in a second json document
+    :returns: the message string and the MessageStructure to send, if any
+    '''
+    if m_struct == 'json':
+        return json.dumps(message), None
+    return message, m_struct or None
+
+def send_sns_message(logger,topic_arn,subject,message,m_struct,m_attr,codec=None):
     '''
     This function publishes an SNS message to the SNS topic
     :param1: logger=the debugger log handle
@@ -107,32 +1112,386 @@ def send_sns_message(logger,topic_arn,subject,message,m_struct,m_attr):
     :param4: subject=this is the subject line
     :param5: m_struct=this is the message format typically json
     :param6: m_attr=this is a dict of message attributes
+    :param7: codec=MessageCodec for the body, None uses the module default, False sends it as is
     :return: repsonse=either the dict of messageId and SequenceNumber
     '''
 
     logger.info(f'Calling {topic_arn} for message')
-    logger.debug(f'Message: {message}')
-    logger.debug(f'MessageStructure: {m_struct}')
-    logger.debug(f'MessageAttributes: {m_attr}')
-    sns_client = boto3.client('sns')
-    if m_struct == 'json':
-        message = json.dumps({'default': json.dumps(message)})
+    logger.debug('Message: %s', _redacted(message))
+    logger.debug('MessageStructure: %s', m_struct)
+    logger.debug('MessageAttributes: %s', _redacted(m_attr))
+    sns_client = aws_client('sns')
+    message, m_struct = _sns_encode(message, m_struct)
+    codec = _resolve_codec(codec)
+    if codec is not None and m_struct is None:
+        message, m_attr = codec.encode(logger, message, m_attr)
+    kw = {'TopicArn': topic_arn, 'Message': message, 'MessageAttributes': m_attr or {}}
+    if subject:
+        kw['Subject'] = subject
+    if m_struct:
+        kw['MessageStructure'] = m_struct
 
     try:
-        response = sns_client.publish(
-            TopicArn = topic_arn,
-            Subject= subject,
-            Message = message,
-            MessageStructure = m_struct,
-            MessageAttributes = m_attr
-        )
+        response = sns_client.publish(**kw)
         logger.info(f'Message sucessfully sent to {topic_arn}')
     except Exception as e:
-        logger.debug(f'Got Exception {e}')
+        logger.debug('Got Exception %s', e)
         response = f'Check Logs. Exception trying to publish message to {topic_arn}'
     
     return response
 
+def send_sns_batch(logger, topic_arn, messages, max_workers=None, max_retries=3, backoff=0.1, codec=None):
+    '''
+    This function publishes many SNS messages with PublishBatch, 10 per call,
+    with the batches sent concurrently on a bounded thread pool
+    :param: logger=the logging handle
+    :param: topic_arn=this is the aws arn of the topic
+    :param: messages=a list of dicts with a message and optionally subject,
+        m_struct, m_attr and for FIFO topics gid and dedup_id
+    :param: max_workers=the most batches in flight, None uses SNS_PUBLISH_WORKERS
+    :param: max_retries=times to resend entries that failed server side
+    :param: backoff=seconds to wait before the first resend, doubled each time
+    :param: codec=MessageCodec for the bodies, None uses the module default, False sends them as is
+    :returns: a list in the same order as messages, each either
+        {'MessageId': ...} or {'Error': {'Code': ..., 'Message': ...}}, every
+        message gets one even when a batch fails on a transport error
+    '''
+    fifo = topic_arn.endswith('.fifo')
+    codec = _resolve_codec(codec)
+    sized = []
+    for i, m in enumerate(messages):
+        body, m_struct = _sns_encode(m['message'], m.get('m_struct'))
+        m_attr = m.get('m_attr')
+        entry = {'Id': str(i)}
+        if fifo:
+            entry['MessageGroupId'] = m.get('gid') or 'default'
+            entry['MessageDeduplicationId'] = m.get('dedup_id') or hashlib.sha256(body.encode()).hexdigest()
+        if codec is not None and m_struct is None:
+            body, m_attr = codec.encode(logger, body, m_attr)
+        entry['Message'] = body
+        if m.get('subject'):
+            entry['Subject'] = m['subject']
+        if m_struct:
+            entry['MessageStructure'] = m_struct
+        if m_attr:
+            entry['MessageAttributes'] = m_attr
+        sized.append((entry, len(body.encode()) + _msg_attr_size(m_attr)))
+    batches = list(_pack_batches(sized, SNS_BATCH_MAX_ENTRIES, SNS_BATCH_MAX_BYTES))
+    logger.info(f'Publishing {len(messages)} message(s) to {topic_arn} in {len(batches)} batch(es)')
+    sns_client = aws_client('sns')
+
+    def publish(batch):
+        #a batch that blows up fails only its own entries, so the results of
+        #batches already published still reach the caller
+        try:
+            return _send_batch_with_retry(
+                logger, lambda entries: sns_client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries),
+                batch, max_retries, backoff)
+        except Exception as e:
+            logger.info(f'Batch publish to {topic_arn} failed: {e}')
+            return [], [{'Id': entry['Id'], 'Code': type(e).__name__, 'Message': str(e), 'SenderFault': False}
+                        for entry in batch]
+
+    results = [None] * len(messages)
+    workers = max(1, min(max_workers or SNS_PUBLISH_WORKERS, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for ok, failed in ex.map(publish, batches):
+            for r in ok:
+                results[int(r['Id'])] = {k: v for k, v in r.items() if k != 'Id'}
+            for f in failed:
+                results[int(f['Id'])] = {'Error': {'Code': f.get('Code'), 'Message': f.get('Message'),
+                                                   'SenderFault': f.get('SenderFault')}}
+    logger.info(f'Published {sum(1 for r in results if r and "MessageId" in r)} of {len(messages)} to {topic_arn}')
+    return results
+
+#reads are streamed in chunks so an object never has to sit in memory whole
+S3_CHUNK_SIZE = int(os.environ.get('LCFS_S3_CHUNK_SIZE', str(1024 * 1024)))
+S3_PART_SIZE = int(os.environ.get('LCFS_S3_PART_SIZE', str(8 * 1024 * 1024)))
+S3_DOWNLOAD_WORKERS = int(os.environ.get('LCFS_S3_DOWNLOAD_WORKERS', '8'))
+
+def _s3_range(start, end):
+    '''Builds an http Range header value, end is inclusive'''
+    return f'bytes={start}-' if end is None else f'bytes={start}-{end}'
+
+def read_s3_range(logger,bucket,key,start,end=None):
+    '''
+    This function reads a byte range of an s3 file
+    :param1: bucket=the bucket name that the file resides in
+    :param2: key=the key to the file
+    :param3: start=the first byte to read
+    :param4: end=the last byte to read, inclusive, None reads to the end
+    :returns: the bytes read
+    '''
+    logger.debug('Reading %s of s3://%s/%s', _s3_range(start, end), bucket, key)
+    data = aws_client('s3').get_object(Bucket=bucket, Key=key, Range=_s3_range(start, end))
+    return data['Body'].read()
+
+def iter_s3_file(logger,bucket,key,encoding='utf-8',lines=False,chunk_size=None,start=None,end=None):
+    '''
+    This function streams an s3 file, decoding it as it goes. Decoding is
+    incremental so a multibyte character split across two chunks comes out whole
+    :param1: bucket=the bucket name that the file resides in
+    :param2: key=the key to the file
+    :param3: encoding=the text encoding, None yields the raw bytes chunks
+    :param4: lines=yield one line at a time, without its line ending
+    :param5: chunk_size=bytes read per chunk, None uses S3_CHUNK_SIZE
+    :param6: start,end=only read this byte range, end is inclusive
+    :returns: a generator of str chunks, lines or bytes chunks
+    '''
+    kw = {}
+    if start is not None or end is not None:
+        kw['Range'] = _s3_range(start or 0, end)
+    try:
+        data = aws_client('s3').get_object(Bucket=bucket, Key=key, **kw)
+    except _botocore_exceptions.ClientError as e:
+        logger.info(f'Error reading {bucket}/{key}: {e.response["Error"]["Code"]}')
+        raise
+    body = data['Body']
+    try:
+        chunks = body.iter_chunks(chunk_size or S3_CHUNK_SIZE)
+        if encoding is None:
+            yield from chunks
+            return
+        decoder = codecs.getincrementaldecoder(encoding)()
+        pending = ''
+        for chunk in chunks:
+            text = decoder.decode(chunk)
+            if not lines:
+                if text:
+                    yield text
+                continue
+            pending += text
+            parts = pending.split('\n')
+            pending = parts.pop()
+            for line in parts:
+                yield line[:-1] if line.endswith('\r') else line
+        text = decoder.decode(b'', final=True)
+        if lines:
+            pending += text
+            if pending:
+                yield pending[:-1] if pending.endswith('\r') else pending
+        elif text:
+            yield text
+    finally:
+        body.close()
+
+def download_s3_parallel(logger,bucket,key,fileobj=None,part_size=None,max_workers=None):
+    '''
+    This function downloads a large s3 file as concurrent ranged reads
+    Every range is pinned to the ETag from the first head so a file that is
+    overwritten mid download fails instead of coming back mixed
+    :param1: bucket=the bucket name that the file resides in
+    :param2: key=the key to the file
+    :param3: fileobj=a seekable binary file to write into, None returns the bytes
+    :param4: part_size=bytes per ranged read, None uses S3_PART_SIZE
+    :param5: max_workers=reads in flight, None uses S3_DOWNLOAD_WORKERS
+    :returns: a bytearray of the file, or the size written when fileobj is given
+    '''
+    s3_client = aws_client('s3')
+    part_size = part_size or S3_PART_SIZE
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    ranges = [(o, min(o + part_size, size) - 1) for o in range(0, size, part_size)]
+    logger.info(f'Downloading s3://{bucket}/{key} ({size} bytes) in {len(ranges)} part(s)')
+    buf = bytearray(size) if fileobj is None else None
+    lock = threading.Lock()
+
+    def fetch(r):
+        data = s3_client.get_object(Bucket=bucket, Key=key, Range=_s3_range(*r), IfMatch=head['ETag'])
+        chunk = data['Body'].read()
+        if buf is not None:
+            buf[r[0]:r[0] + len(chunk)] = chunk
+        else:
+            with lock:
+                fileobj.seek(r[0])
+                fileobj.write(chunk)
+
+    workers = max(1, min(max_workers or S3_DOWNLOAD_WORKERS, len(ranges)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(fetch, ranges))
+    return buf if fileobj is None else size
+
+#reference files (payee lists, templates, config json) can be kept in the
+#lambda's /tmp between warm invocations. Every use still does a conditional
+#GET on the stored ETag so a changed object is picked up, but an unchanged one
+#only costs a 304
+S3_CACHE_DIR = os.environ.get('LCFS_S3_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'lcfs-s3-cache'))
+S3_CACHE_MAX_BYTES = int(os.environ.get('LCFS_S3_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+class S3FileCache:
+    '''Keeps s3 objects as local files under a total size budget, evicting the
+    least recently used. Files are written to a temp name and renamed into
+    place so no thread ever sees a partial file, and callers get an already
+    open handle so an eviction after the fact cannot pull the file out from
+    under them
+    '''
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or S3_CACHE_DIR
+        self.max_bytes = S3_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(self.directory, exist_ok=True)
+        #files an earlier cache left here have no index entry, so they are
+        #dropped, only names this class writes so a shared directory is safe
+        for name in os.listdir(self.directory):
+            if not self._owned(name):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _owned(name):
+        '''True for the sha256 hex file names and partial temp files the cache writes'''
+        if name.startswith('.partial-'):
+            return True
+        return len(name) == 64 and all(c in '0123456789abcdef' for c in name)
+
+    def _key_lock(self, k):
+        with self._lock:
+            return self._key_locks.setdefault(k, threading.Lock())
+
+    def _evict(self, keep):
+        '''Drops least recently used files until under budget, skipping any
+        that another thread is refreshing right now'''
+        with self._lock:
+            for k in list(self._index):
+                if self._bytes <= self.max_bytes:
+                    break
+                if k == keep:
+                    continue
+                lock = self._key_locks.get(k)
+                if lock is not None and not lock.acquire(blocking=False):
+                    continue
+                try:
+                    entry = self._index.pop(k)
+                    self._bytes -= entry['size']
+                    self.evictions += 1
+                    try:
+                        os.remove(entry['path'])
+                    except OSError:
+                        pass
+                finally:
+                    if lock is not None:
+                        lock.release()
+
+    def open(self, logger, bucket, key):
+        '''This function returns an open binary file of the current object
+        :param: logger=the logging handle
+        :param: bucket=the bucket name that the file resides in
+        :param: key=the key to the file
+        :returns: a binary file object, the caller closes it
+        '''
+        k = (bucket, key)
+        with self._key_lock(k):
+            with self._lock:
+                entry = self._index.get(k)
+            kw = {'IfNoneMatch': entry['etag']} if entry else {}
+            try:
+                data = aws_client('s3').get_object(Bucket=bucket, Key=key, **kw)
+            except _botocore_exceptions.ClientError as e:
+                if entry and e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304:
+                    try:
+                        f = open(entry['path'], 'rb')
+                    except OSError:
+                        f = None
+                    if f is not None:
+                        with self._lock:
+                            self._index.move_to_end(k)
+                            self.hits += 1
+                        logger.debug('Cache hit for s3://%s/%s', bucket, key)
+                        return f
+                    data = aws_client('s3').get_object(Bucket=bucket, Key=key)
+                else:
+                    raise
+            path = os.path.join(self.directory, hashlib.sha256(f'{bucket}/{key}'.encode()).hexdigest())
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.partial-')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    for chunk in data['Body'].iter_chunks(S3_CHUNK_SIZE):
+                        out.write(chunk)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            f = open(path, 'rb')
+            size = os.fstat(f.fileno()).st_size
+            with self._lock:
+                old = self._index.pop(k, None)
+                if old:
+                    self._bytes -= old['size']
+                self._index[k] = {'path': path, 'etag': data['ETag'], 'size': size}
+                self._bytes += size
+                self.misses += 1
+            logger.debug('Cached s3://%s/%s (%s bytes)', bucket, key, size)
+        self._evict(k)
+        return f
+
+    def read(self, logger, bucket, key):
+        '''Returns the object's bytes'''
+        with self.open(logger, bucket, key) as f:
+            return f.read()
+
+    def mmap(self, logger, bucket, key):
+        '''Returns a read only memory map of the object, so large files are
+        paged in on demand instead of read into memory. Empty objects give b''
+        '''
+        with self.open(logger, bucket, key) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def clear(self):
+        '''Drops every cached file'''
+        with self._lock:
+            for entry in self._index.values():
+                try:
+                    os.remove(entry['path'])
+                except OSError:
+                    pass
+            self._index.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''Returns the hit, miss and eviction counters and current size'''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._index), 'bytes': self._bytes}
+
+_s3_cache = None
+
+def enable_s3_cache(directory=None, max_bytes=None):
+    '''This function turns on the /tmp cache used by read_s3_file and dau_copy_to
+    :param: directory=where cached files live, None uses S3_CACHE_DIR
+    :param: max_bytes=the total size budget, None uses S3_CACHE_MAX_BYTES
+    :returns: the S3FileCache
+    '''
+    global _s3_cache
+    disable_s3_cache()
+    _s3_cache = S3FileCache(directory, max_bytes)
+    return _s3_cache
+
+def disable_s3_cache():
+    '''This function turns off the /tmp cache and removes its files'''
+    global _s3_cache
+    cache, _s3_cache = _s3_cache, None
+    if cache is not None:
+        cache.clear()
+
+def s3_cache_stats():
+    '''This function returns the /tmp cache counters, None when it is off'''
+    return _s3_cache.stats() if _s3_cache is not None else None
+
+if os.environ.get('LCFS_S3_CACHE'):
+    enable_s3_cache()
+
 def read_s3_file(logger,bucket,key,encoding):
     '''
     This function takes a bucket and a key and returns the data from the s3 file
@@ -141,52 +1500,58 @@ def read_s3_file(logger,bucket,key,encoding):
     :param3: type=this is the file type
     :returns: contents=the output of the s3 read command
     '''
-    s3_client = boto3.client('s3')
-    # Get s3 object contents based on bucket name and object key; in bytes and convert to string
-    try:
-        data = s3_client.get_object(Bucket=bucket, Key=key)
-    except ClientError as e:
-        logger.info(f'Error reading {bucket}/{key}: {e.data["Error"]["Code"]}')
-    #io.BytesIO(data.get('Body').read())
-    contents = data['Body'].read().decode(encoding)    
+    if _s3_cache is not None:
+        with _s3_cache.open(logger, bucket, key) as f:
+            return io.TextIOWrapper(f, encoding=encoding, newline='').read()
+    # stream the object and decode it chunk by chunk rather than holding the
+    # whole body as bytes and then again as str
+    contents = ''.join(iter_s3_file(logger, bucket, key, encoding))
 
     return contents
 
+PNS_TOPIC_ARN = 'arn:aws:sns:us-west-2:386461531385:application_error'
+#set our MessageAttributes so we can filter off the SNS message
+PNS_MSG_ATTR = {
+        "application" : {
+            "DataType" : "String",
+            "StringValue" : "print-checks"
+        },
+        "error" : {
+            "DataType" : "String",
+            "StringValue" : "Billpay json has unexpected data"
+        }
+}
+
 def pns_msg(logger,subject,msg):
     '''
     This function gets called by process_s3. It preps and sends the SNS
     message
     :param1: subject=this is the subject of the notification
     :param2: msg=this is the message in json format
-    :param3: ***msgAtt=this is a kwags array of message attributes
     :returns: no return
     '''
-    #set our MessageAttributes so we can filter off the SNS message
     logger.info(f'Setting up our Message')
-    m = json.dumps(msg)
-    n = ['default', m]
-    msg = json.dumps(n)
-    ms = 'json'
-    ma ={
-            "application" : {
-                "DataType" : "String",
-                "StringValue" : "print-checks"
-            },
-            "error" : {
-                "DataType" : "String",
-                "StringValue" : "Billpay json has unexpected data"
-            }      
-    }
-
-    ms = json.dumps(ms)
-    #resp = lcfsLambdaLib.send_sns_message(logger,tp_arn,msg,ms,ma)
-    #logger.debug(dir(lcfsLambdaLib))
-    tp_arn='arn:aws:sns:us-west-2:386461531385:application_error'
-    resp = send_sns_message(logger,tp_arn,subject,msg,ms,ma)
-    if resp['MessageId']:
+    resp = send_sns_message(logger,PNS_TOPIC_ARN,subject,msg,'json',PNS_MSG_ATTR)
+    if isinstance(resp, dict) and resp.get('MessageId'):
         logger.info(f'{resp["MessageId"]} published to recievers.')
     else:
-        logger.debug(f'Recieved Error {resp["MessageId"]}')
+        logger.debug('Recieved Error %s', resp)
+
+def pns_msgs(logger,msgs):
+    '''
+    This function sends many application error notifications at once with
+    send_sns_batch
+    :param: msgs=a list of (subject, msg) pairs, msg in json format
+    :returns: the per message results from send_sns_batch
+    '''
+    logger.info(f'Setting up {len(msgs)} Message(s)')
+    batch = [{'message': msg, 'subject': subject, 'm_struct': 'json', 'm_attr': PNS_MSG_ATTR}
+             for subject, msg in msgs]
+    results = send_sns_batch(logger, PNS_TOPIC_ARN, batch)
+    for r in results:
+        if 'Error' in r:
+            logger.debug('Recieved Error %s', r["Error"])
+    return results
 
 def ssm_params(**kw):
     '''This function will CRU parameters from SSM
@@ -199,25 +1564,17 @@ def ssm_params(**kw):
     '''
     t = kw['type']
     logger = kw['logger']
-    logger.debug(f'Starting parameter pull for parm type {t}')
-    logger.debug(f'Getting parameter(s) {kw}')
-    a = {}
-    ssm_client = boto3.client('ssm')
+    logger.debug('Starting parameter pull for parm type %s', t)
+    logger.debug('Getting parameter(s) %s', _redacted(kw))
+    ssm_client = aws_client('ssm')
     if t == 'r':
         path = kw['name']
         enc = kw['enc']
+        a = ssm_get_parameters(logger, path, enc)
+        logger.debug('Sucessfully pulled value(s) for %s', path)
         if isinstance(path, str):
-            param1 = ssm_client.get_parameter(Name=path, WithDecryption=enc)
-            a = param1['Parameter']['Value']
-            logger.debug(f'Sucessfully pulled value from {a}')
-            return a
-        else:
-            for i in path:
-                param1 = ssm_client.get_parameter(Name=i, WithDecryption=enc)
-                logger.debug(f'Sucessfully pulled value from {param1}')
-                a[i] = param1['Parameter']['Value']
-                logger.debug(f'Sucessfully pulled value from {a[i]}')
-                return a
+            return a[path]
+        return a
     elif t == 'c':
         name = kw['name']
         desc = kw['desc']
@@ -234,7 +1591,8 @@ def ssm_params(**kw):
                             'Value': 'left coast'
                         }]
                 )
-        logger.debug(f'SSM parameter(s) done: {resp}')
+        invalidate_ssm_cache(name)
+        logger.debug('SSM parameter(s) done: %s', resp)
         return resp
     elif t == 'u':
         name = kw['name']
@@ -244,27 +1602,406 @@ def ssm_params(**kw):
                     Value=v,
                     Overwrite=True
                 )
-        logger.debug(f'SSM parameter(s) done: {resp}')
+        invalidate_ssm_cache(name)
+        logger.debug('SSM parameter(s) done: %s', resp)
         return resp
     else:
-        logger.debug(f'Error, no SSM type provided: {type}')
+        logger.debug('Error, no SSM type provided: %s', type)
         return False
 
+#dropbox clients are built once per set of credentials and kept at module
+#level, so the refreshed access token survives warm invocations and is only
+#refreshed again when it expires. Each session also keeps an index of folders
+#known to exist, filled from a recursive files_list_folder and kept current
+#with list_folder/continue, so folder creation skips folders that are already
+#there and sends the rest in one files_create_folder_batch
+DBX_INDEX_TTL = float(os.environ.get('LCFS_DBX_INDEX_TTL', '60'))
+_dbx_sessions = {}
+_dbx_sessions_lock = threading.RLock()
+
+def _dbx_key(path):
+    '''Index key for a dropbox path, dropbox paths are case insensitive'''
+    return path.strip().rstrip('/').lower()
+
+class DropboxSession:
+    '''One Dropbox client, built lazily from a refresh token or adopted from
+    the caller, plus the index of folders known to exist under it. Folders
+    can go missing behind the index's back between refreshes, which is safe
+    because dropbox uploads create missing parent folders
+    :param: client=an existing Dropbox client to adopt instead of building one
+    :param: app_key=the dropbox app key
+    :param: app_secret=the dropbox app secret
+    :param: refresh_token=the oauth2 refresh token
+    :param: team_member_id=act as this team member through a DropboxTeam token
+    :param: index_ttl=seconds before an indexed folder is refreshed, None uses DBX_INDEX_TTL
+    '''
+
+    def __init__(self, client=None, app_key=None, app_secret=None, refresh_token=None, team_member_id=None,
+                 index_ttl=None):
+        self._client = None
+        self._creds = (app_key, app_secret, refresh_token, team_member_id)
+        self.index_ttl = DBX_INDEX_TTL if index_ttl is None else index_ttl
+        self._folders = {'': ''}
+        self._roots = {}
+        self._lock = threading.RLock()
+        if client is not None:
+            self._own(client)
+
+    def _own(self, client):
+        '''Times the client and points it back at this session, so helpers that
+        are handed the client still find the session's folder index. The two
+        only reference each other, so an adopted client and its index are
+        collected together once the caller lets go of both'''
+        self._client = instrument_dropbox(client)
+        self._client._lcfs_session = self
+
+    @property
+    def client(self):
+        '''The Dropbox client, built and given a fresh access token on first use'''
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._own(self._build())
+        return self._client
+
+    def _build(self):
+        app_key, app_secret, refresh_token, member = self._creds
+        if refresh_token is None:
+            raise ValueError('DropboxSession needs a client or a refresh token')
+        if member:
+            team = dropbox.DropboxTeam(oauth2_refresh_token=refresh_token, app_key=app_key, app_secret=app_secret)
+            client = team.as_user(member)
+        else:
+            client = dropbox.Dropbox(oauth2_refresh_token=refresh_token, app_key=app_key, app_secret=app_secret)
+        client.check_and_refresh_access_token()
+        return client
+
+    def reset_client(self):
+        '''Drops a built client so the next use builds a new one, call it after
+        an AuthError. Adopted clients are kept'''
+        with self._lock:
+            if self._creds[2] is not None:
+                self._client = None
+
+    def known(self, path):
+        '''Whether path is a folder the index knows about'''
+        with self._lock:
+            return _dbx_key(path) in self._folders
+
+    def _add(self, path):
+        path = path.rstrip('/')
+        while path and _dbx_key(path) not in self._folders:
+            self._folders[_dbx_key(path)] = path
+            path = path.rsplit('/', 1)[0]
+
+    def _remove(self, path):
+        key = _dbx_key(path)
+        for k in [k for k in self._folders if k == key or k.startswith(key + '/')]:
+            if k:
+                del self._folders[k]
+
+    def index_folder(self, logger, root='', force=False):
+        '''This method lists root recursively into the folder index. Later calls
+        only fetch the changes since the last cursor, and not at all within
+        index_ttl seconds of the last one
+        :param: logger=the logging handle
+        :param: root=the folder to index, '' is the whole account
+        :param: force=list root again from scratch
+        :returns: nothing
+        '''
+        key = _dbx_key(root)
+        with self._lock:
+            state = self._roots.get(key)
+        if state is not None and not force and time.monotonic() - state[1] < self.index_ttl:
+            return
+        client = self.client
+        full = state is None or force
+        entries = []
+        try:
+            res = client.files_list_folder(root, recursive=True) if full else client.files_list_folder_continue(state[0])
+            entries.extend(res.entries)
+            while res.has_more:
+                res = client.files_list_folder_continue(res.cursor)
+                entries.extend(res.entries)
+        except dropbox.exceptions.ApiError as e:
+            err = e.error
+            if not full and isinstance(err, dropbox.files.ListFolderContinueError) and err.is_reset():
+                logger.debug('Cursor for %s was reset, listing it again', root)
+                return self.index_folder(logger, root, force=True)
+            if isinstance(err, dropbox.files.ListFolderError) and err.is_path() and err.get_path().is_not_found():
+                logger.debug('Folder %s does not exist, nothing to index', root)
+                with self._lock:
+                    self._roots.pop(key, None)
+                    self._remove(root)
+                return
+            raise
+        with self._lock:
+            if full:
+                self._remove(root)
+                self._add(root)
+            for entry in entries:
+                if isinstance(entry, dropbox.files.FolderMetadata):
+                    self._add(entry.path_display)
+                elif isinstance(entry, dropbox.files.DeletedMetadata):
+                    self._remove(entry.path_lower)
+            self._roots[key] = (res.cursor, time.monotonic())
+        logger.debug('Indexed %s entries under %s, %s folders known', len(entries), root or '/', len(self._folders))
+
+    def refresh(self, logger):
+        '''This method brings every indexed folder whose ttl has run out up to date
+        :param: logger=the logging handle
+        :returns: nothing
+        '''
+        with self._lock:
+            roots = [(key, state) for key, state in self._roots.items()]
+        for key, state in roots:
+            if time.monotonic() - state[1] >= self.index_ttl:
+                self.index_folder(logger, key)
+
+    def ensure_folders(self, logger, paths):
+        '''This method makes sure folders exist, skipping the ones the index
+        knows about and creating the rest with files_create_folder_batch.
+        Folders that turn out to exist already count as created, only those
+        and the ones actually created go into the index. A path blocked by a
+        file fails and is kept out of it
+        :param: logger=the logging handle
+        :param: paths=the folder paths
+        :returns: a dict of path to the folder's path_display, or None if it failed
+        '''
+        self.refresh(logger)
+        paths = list(dict.fromkeys(paths))
+        out = {}
+        missing = []
+        with self._lock:
+            for path in paths:
+                display = self._folders.get(_dbx_key(path))
+                if display is None:
+                    missing.append(path)
+                else:
+                    out[path] = display
+        logger.debug('%s of %s folder(s) already known', len(out), len(paths))
+        if missing:
+            created = _dbx_create_folder_batch(logger, self.client, missing)
+            with self._lock:
+                for path, display in created.items():
+                    if display is not None:
+                        self._add(display)
+                    else:
+                        self._remove(path)
+            out.update(created)
+        return {path: out[path] for path in paths}
+
+def dropbox_session(app_key, app_secret, refresh_token, team_member_id=None, **kw):
+    '''This function returns the shared DropboxSession for a set of credentials
+    :param: app_key=the dropbox app key
+    :param: app_secret=the dropbox app secret
+    :param: refresh_token=the oauth2 refresh token
+    :param: team_member_id=act as this team member through a DropboxTeam token
+    :param: kw=DropboxSession options used the first time the session is built
+    :returns: the DropboxSession, pass it or its client to the dau helpers
+    '''
+    key = (app_key, hashlib.sha256(refresh_token.encode()).hexdigest(), team_member_id)
+    session = _dbx_sessions.get(key)
+    if session is None:
+        with _dbx_sessions_lock:
+            session = _dbx_sessions.get(key)
+            if session is None:
+                session = DropboxSession(app_key=app_key, app_secret=app_secret, refresh_token=refresh_token,
+                                         team_member_id=team_member_id, **kw)
+                _dbx_sessions[key] = session
+    return session
+
+def _dbx_session(dbx):
+    '''Returns the session for a DropboxSession or a client, adopting clients
+    the caller built so their folder index lives as long as they do'''
+    if isinstance(dbx, DropboxSession):
+        return dbx
+    with _dbx_sessions_lock:
+        session = getattr(dbx, '_lcfs_session', None)
+        if session is None:
+            session = DropboxSession(client=dbx)
+    return session
+
+def _dbx_client(dbx):
+    '''Returns the timed client for a DropboxSession or a client'''
+    if isinstance(dbx, DropboxSession):
+        return dbx.client
+    return instrument_dropbox(dbx)
+
+def reset_dropbox_sessions():
+    '''This function drops every cached session, used by tests and when
+    credentials are rotated. Clients the caller built keep their index until
+    they are dropped
+    :returns: nothing
+    '''
+    with _dbx_sessions_lock:
+        _dbx_sessions.clear()
+
 def dau_create_folder(logger,dbx_as_user,folder_path,folder_name):
-    '''This function calls dropbox to create a folder
+    '''This function makes sure a dropbox folder exists, creating it only when
+    the session's folder index does not already know about it
     :param: logger=the logging handle
-    :param: dbx_as_user=the dropbox session
+    :param: dbx_as_user=the dropbox session, a DropboxSession or a Dropbox client
     :param: fodler_path=the path the folder will be created in
     :param: folder_name=the name of the folder to create
-    :returns: the path to the new folder
+    :returns: the path to the folder, or None if it could not be created
     '''
     logger.info(f'Got a dropbox folder create request')
     fn = f'{folder_path}{folder_name}'
     logger.info(f'Creating new folder {folder_name} in {folder_path}')
-    a = dbx_as_user.files_create_folder_v2(fn)
+    a = _dbx_session(dbx_as_user).ensure_folders(logger, [fn])[fn]
     logger.info(f'Folder creation complete')
-    logger.debug(f'Folder created {a.path_display}')
-    return a.path_display
+    logger.debug('Folder created %s', a)
+    return a
+
+#files move between s3 and dropbox one chunk at a time so peak memory is a few
+#chunks whatever the file size. Dropbox caps a single upload request at 150 MB
+#and s3 multipart parts must be at least 5 MB, except the last
+TRANSFER_CHUNK_SIZE = int(os.environ.get('LCFS_TRANSFER_CHUNK_SIZE', str(8 * 1024 * 1024)))
+TRANSFER_WORKERS = int(os.environ.get('LCFS_TRANSFER_WORKERS', '4'))
+DBX_MAX_CHUNK_SIZE = 150 * 1024 * 1024
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+
+def _rechunk(pieces, size):
+    '''Regroups an iterator of bytes into chunks of exactly size, the last may be short'''
+    buf = bytearray()
+    for piece in pieces:
+        buf += piece
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+def _iter_s3_ranges(logger, bn, bk, size, chunk_size, etag):
+    '''Yields an s3 object as ranged reads, fetching the next range while the
+    caller works on the current one'''
+    ranges = [(o, min(o + chunk_size, size) - 1) for o in range(0, size, chunk_size)]
+    s3_client = aws_client('s3')
+
+    def read(r):
+        return s3_client.get_object(Bucket=bn, Key=bk, Range=_s3_range(*r), IfMatch=etag)['Body'].read()
+
+    if not ranges:
+        return
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fut = ex.submit(read, ranges[0])
+        for r in ranges[1:]:
+            data = fut.result()
+            fut = ex.submit(read, r)
+            yield data
+        yield fut.result()
+
+def _dropbox_upload_chunks(logger, dbx_as_user, chunks, size, dbx_path, mode=None):
+    '''Uploads an iterator of chunks totalling size bytes to dropbox, as one
+    files_upload when it fits in a single chunk or as an upload session'''
+    mode = mode or dropbox.files.WriteMode.add
+    first = next(chunks, b'')
+    if len(first) >= size:
+        return dbx_as_user.files_upload(first, dbx_path, mode=mode)
+    session = dbx_as_user.files_upload_session_start(first)
+    cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=len(first))
+    commit = dropbox.files.CommitInfo(path=dbx_path, mode=mode)
+    logger.debug('Started upload session for %s', dbx_path)
+    for chunk in chunks:
+        if cursor.offset + len(chunk) >= size:
+            return dbx_as_user.files_upload_session_finish(chunk, cursor, commit)
+        dbx_as_user.files_upload_session_append_v2(chunk, cursor)
+        cursor.offset += len(chunk)
+    return dbx_as_user.files_upload_session_finish(b'', cursor, commit)
+
+def _chain_first(first, second, rest):
+    '''Puts the two chunks we peeked at back in front of the rest'''
+    yield first
+    yield second
+    yield from rest
+
+def s3_to_dropbox(logger,bn,bk,dbx_as_user,dbx_path,chunk_size=None,mode=None,cached=None):
+    '''This function streams an s3 file into dropbox, piping ranged s3 reads
+    into a dropbox upload session
+    :param: logger=our logging handle
+    :param: bn=s3 bucket name to read from
+    :param: bk=s3 bucket key to read from
+    :param: dbx_as_user=the dropbox session
+    :param: dbx_path=the path that the file will be copied to and filename
+    :param: chunk_size=bytes per read and upload call, None uses TRANSFER_CHUNK_SIZE
+    :param: mode=the dropbox WriteMode, None adds like files_upload does
+    :param: cached=read through the /tmp cache, None uses it when it is enabled
+    :returns: the dropbox FileMetadata of the uploaded file
+    '''
+    dbx_as_user = _dbx_client(dbx_as_user)
+    chunk_size = min(chunk_size or TRANSFER_CHUNK_SIZE, DBX_MAX_CHUNK_SIZE)
+    if _s3_cache is not None and cached is not False:
+        with _s3_cache.open(logger, bn, bk) as f:
+            size = os.fstat(f.fileno()).st_size
+            logger.info(f'Uploading cached s3://{bn}/{bk} ({size} bytes) to {dbx_path}')
+            return _dropbox_upload_chunks(logger, dbx_as_user, iter(lambda: f.read(chunk_size), b''),
+                                          size, dbx_path, mode)
+    head = aws_client('s3').head_object(Bucket=bn, Key=bk)
+    size = head['ContentLength']
+    logger.info(f'Streaming s3://{bn}/{bk} ({size} bytes) to {dbx_path}')
+    chunks = _iter_s3_ranges(logger, bn, bk, size, chunk_size, head['ETag'])
+    try:
+        return _dropbox_upload_chunks(logger, dbx_as_user, chunks, size, dbx_path, mode)
+    finally:
+        chunks.close()
+
+def dropbox_to_s3(logger,dbx_as_user,dbx_file,bn,bk,chunk_size=None,max_workers=None,extra_args=None):
+    '''This function streams a dropbox file into s3, as a single put when it
+    fits in one chunk and otherwise as a multipart upload with parts sent in
+    parallel. At most max_workers parts are held in memory at a time
+    :param: logger=the logging handle
+    :param: dbx_as_user=the dropbox session
+    :param: dbx_file=the dropbox path and filename to copy
+    :param: bn=s3 bucket name to write to
+    :param: bk=s3 bucket key to write to
+    :param: chunk_size=bytes per part, None uses TRANSFER_CHUNK_SIZE
+    :param: max_workers=parts in flight, None uses TRANSFER_WORKERS
+    :param: extra_args=extra put_object args ie Metadata, ContentType
+    :returns: the dropbox FileMetadata of the copied file
+    '''
+    dbx_as_user = _dbx_client(dbx_as_user)
+    s3_client = aws_client('s3')
+    extra_args = extra_args or {}
+    meta, res = dbx_as_user.files_download(dbx_file)
+    part_size = max(chunk_size or TRANSFER_CHUNK_SIZE, S3_MIN_PART_SIZE, -(-meta.size // S3_MAX_PARTS))
+    logger.info(f'Streaming {meta.path_display} ({meta.size} bytes) to s3://{bn}/{bk}')
+    try:
+        chunks = _rechunk(res.iter_content(chunk_size=64 * 1024), part_size)
+        first = next(chunks, b'')
+        second = next(chunks, None)
+        if second is None:
+            s3_client.put_object(Bucket=bn, Key=bk, Body=first, **extra_args)
+            return meta
+        upload_id = s3_client.create_multipart_upload(Bucket=bn, Key=bk, **extra_args)['UploadId']
+        try:
+            workers = max_workers or TRANSFER_WORKERS
+            slots = threading.BoundedSemaphore(workers)
+
+            def upload(n, body):
+                try:
+                    r = s3_client.upload_part(Bucket=bn, Key=bk, UploadId=upload_id, PartNumber=n, Body=body)
+                    return {'PartNumber': n, 'ETag': r['ETag']}
+                finally:
+                    slots.release()
+
+            futures = []
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                for n, body in enumerate(_chain_first(first, second, chunks), 1):
+                    slots.acquire()
+                    futures.append(ex.submit(upload, n, body))
+                    del body
+            parts = [f.result() for f in futures]
+            s3_client.complete_multipart_upload(Bucket=bn, Key=bk, UploadId=upload_id,
+                                                MultipartUpload={'Parts': parts})
+            logger.debug('Completed %s part upload to s3://%s/%s', len(parts), bn, bk)
+        except Exception:
+            s3_client.abort_multipart_upload(Bucket=bn, Key=bk, UploadId=upload_id)
+            raise
+    finally:
+        res.close()
+    return meta
 
 def dau_copy_to(logger,bn,bk,dbx_as_user,dbx_path):
     '''This function takes s3 file and copies it to dropbox
@@ -275,21 +2012,18 @@ def dau_copy_to(logger,bn,bk,dbx_as_user,dbx_path):
     :param: dbx_path=the path that the file will be copied to and filename
     :returns: the path and fielname in dropbox
     '''
+    dbx_as_user = _dbx_client(dbx_as_user)
     logger.info(f'Got a request to copy files from s3 to dropbox')
-    s3_client = boto3.client('s3')
     try:
-        data = s3_client.get_object(Bucket=bn, Key=bk)
-    except ClientError as e:
+        a = s3_to_dropbox(logger, bn, bk, dbx_as_user, dbx_path)
+        logger.debug('Sucessfully uploaded %s', a.path_display)
+    except _botocore_exceptions.ClientError as e:
         error_code = e.response["Error"]["Code"]
-        logger.debug(f'Was not able to read s3://{bn}{bk}')
-        logger.debug(f'Recived error code {error_code}')
+        logger.debug('Was not able to read s3://%s%s', bn, bk)
+        logger.debug('Recived error code %s', error_code)
         return
-    logger.info(f'sucessfully read in s3://{bn}{bk}')
-    try:
-        a = dbx_as_user.files_upload(data['Body'].read(), dbx_path)
-        logger.debug(f'Sucessfully uploaded {a.path_display}')
     except dropbox.exceptions.ApiError as e:
-        logger.debug(f'Recived error {e}')
+        logger.debug('Recived error %s', e)
         return
     logger.info(f'sucessfully read in s3://{bn}{bk}')
     return a.path_display
@@ -304,24 +2038,446 @@ def dau_to_s3(logger,dbx_as_user,dbx_path,dbx_filename,bk,bn):
     :param: dbx_file_name=the naem of the file in dbx
     :returns: the bucket and key in s3
     '''
+    dbx_as_user = _dbx_client(dbx_as_user)
     logger.info(f'Got a request to copy files from dropbox to s3')
-    s3_client = boto3.client('s3')
-    #s3_resource = boto3.resource('s3')
     DBX_PATH = f'{dbx_path}{dbx_filename}'
-    #grab our file from the dropbox side
+    #stream our file from the dropbox side straight into s3
     try:
-        meta, res = dbx_as_user.files_download(DBX_PATH)
-        logger.debug(f'Sucessfully pulled down {meta.name} with response {res}')
+        meta = dropbox_to_s3(logger, dbx_as_user, DBX_PATH, bn, bk)
     except dropbox.exceptions.ApiError as e:
-        logger.debug(f'Recived error {e}')
+        logger.debug('Recived error %s', e)
         return
     logger.info(f'sucessfully downloaded {meta.name}')
-
-    #getting a bucket object
-    s3_client.upload_fileobj(io.BytesIO(res.content), bn, bk)
     logger.info(f'sucessfully read in s3://{bn}/{bk}')
     return bk
 
+#bulk sync records the dropbox content_hash on the s3 copy so unchanged files
+#can be skipped on the next run without reading them
+DBX_HASH_META = 'dropbox-content-hash'
+SYNC_WORKERS = int(os.environ.get('LCFS_SYNC_WORKERS', '8'))
+DBX_FOLDER_BATCH_SIZE = 1000
+
+def dau_list_folder(logger,dbx_as_user,folder,recursive=True):
+    '''This function lists a dropbox folder, following the cursor until every
+    page has been read
+    :param: logger=the logging handle
+    :param: dbx_as_user=the dropbox session
+    :param: folder=the folder to list
+    :param: recursive=list everything below the folder, not just its children
+    :returns: a list of the dropbox metadata entries
+    '''
+    dbx_as_user = _dbx_client(dbx_as_user)
+    res = dbx_as_user.files_list_folder(folder, recursive=recursive)
+    entries = list(res.entries)
+    while res.has_more:
+        res = dbx_as_user.files_list_folder_continue(res.cursor)
+        entries.extend(res.entries)
+    logger.debug('Listed %s entries under %s', len(entries), folder)
+    return entries
+
+def list_s3_prefix(logger,bn,prefix):
+    '''This function lists every object under an s3 prefix
+    :param: logger=the logging handle
+    :param: bn=s3 bucket name
+    :param: prefix=the key prefix to list
+    :returns: a dict of key to the listed object (Size, ETag, LastModified)
+    '''
+    objects = {}
+    paginator = aws_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bn, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj
+    logger.debug('Listed %s objects under s3://%s/%s', len(objects), bn, prefix)
+    return objects
+
+def dau_create_folders(logger,dbx_as_user,paths):
+    '''This function makes sure many dropbox folders exist. Folders the
+    session's index knows about are skipped, the rest go out in
+    files_create_folder_batch calls and folders that already exist are not
+    treated as errors
+    :param: logger=the logging handle
+    :param: dbx_as_user=the dropbox session, a DropboxSession or a Dropbox client
+    :param: paths=the folder paths to create
+    :returns: a dict of path to the folder's path_display, or None if it failed
+    '''
+    return _dbx_session(dbx_as_user).ensure_folders(logger, paths)
+
+def _dbx_create_folder_batch(logger, dbx_as_user, paths):
+    '''Creates folders with files_create_folder_batch, 1000 per call, and
+    counts conflicts with an existing folder as success'''
+    out = {}
+    paths = list(paths)
+    for i in range(0, len(paths), DBX_FOLDER_BATCH_SIZE):
+        chunk = paths[i:i + DBX_FOLDER_BATCH_SIZE]
+        launch = dbx_as_user.files_create_folder_batch(chunk, autorename=False)
+        if launch.is_async_job_id():
+            job_id = launch.get_async_job_id()
+            status = dbx_as_user.files_create_folder_batch_check(job_id)
+            while status.is_in_progress():
+                time.sleep(0.5)
+                status = dbx_as_user.files_create_folder_batch_check(job_id)
+            if not status.is_complete():
+                logger.info(f'Folder batch {job_id} failed: {status}')
+                out.update({p: None for p in chunk})
+                continue
+            result = status.get_complete()
+        else:
+            result = launch.get_complete()
+        for path, entry in zip(chunk, result.entries):
+            if entry.is_success():
+                out[path] = entry.get_success().metadata.path_display
+                continue
+            err = entry.get_failure()
+            #only a folder already there counts, a file in the way or above
+            #it is a real failure
+            if err.is_path() and err.get_path().is_conflict() and err.get_path().get_conflict().is_folder():
+                out[path] = path
+            else:
+                logger.debug('Could not create folder %s: %s', path, err)
+                out[path] = None
+    logger.info(f'Folder batch done for {len(paths)} folder(s)')
+    return out
+
+def _sync_manifest():
+    return {'copied': [], 'skipped': [], 'failed': [], 'timings': {}}
+
+def _run_sync(logger, jobs, max_workers, manifest):
+    '''Runs (source, dest, fn) jobs on a bounded pool, fn returns True when it
+    copied and False when it skipped'''
+    def run(job):
+        source, dest, fn = job
+        try:
+            return source, dest, fn(), None
+        except Exception as e:
+            logger.debug('Sync of %s failed: %s', source, e)
+            return source, dest, None, str(e)
+
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers or SYNC_WORKERS, len(jobs)))) as ex:
+        for source, dest, copied, error in ex.map(run, jobs):
+            entry = {'source': source, 'dest': dest}
+            if error is not None:
+                manifest['failed'].append(dict(entry, error=error))
+            elif copied:
+                manifest['copied'].append(entry)
+            else:
+                manifest['skipped'].append(entry)
+
+def dau_sync_to_s3(logger,dbx_as_user,dbx_folder,bn,prefix,max_workers=None):
+    '''This function mirrors a dropbox folder tree to an s3 prefix
+    Files whose s3 copy carries the same dropbox content_hash are skipped
+    :param: logger=the logging handle
+    :param: dbx_as_user=the dropbox session
+    :param: dbx_folder=the dropbox folder to copy from ie /Statements
+    :param: bn=s3 bucket name to write to
+    :param: prefix=the key prefix to write under ie statements/
+    :param: max_workers=copies in flight, None uses SYNC_WORKERS
+    :returns: a manifest dict of copied, skipped and failed files and timings
+    '''
+    dbx_as_user = _dbx_client(dbx_as_user)
+    manifest = _sync_manifest()
+    t0 = time.monotonic()
+    root = dbx_folder.rstrip('/').lower()
+    files = [e for e in dau_list_folder(logger, dbx_as_user, dbx_folder)
+             if isinstance(e, dropbox.files.FileMetadata)]
+    existing = list_s3_prefix(logger, bn, prefix)
+    t1 = time.monotonic()
+    s3_client = aws_client('s3')
+
+    def job(meta, key):
+        def copy():
+            obj = existing.get(key)
+            if obj is not None and obj['Size'] == meta.size:
+                stored = s3_client.head_object(Bucket=bn, Key=key).get('Metadata', {})
+                if stored.get(DBX_HASH_META) == meta.content_hash:
+                    return False
+            dropbox_to_s3(logger, dbx_as_user, meta.path_lower, bn, key,
+                          extra_args={'Metadata': {DBX_HASH_META: meta.content_hash}})
+            return True
+        return (meta.path_display, key, copy)
+
+    jobs = [job(m, prefix + m.path_display[len(root):].lstrip('/')) for m in files]
+    _run_sync(logger, jobs, max_workers, manifest)
+    t2 = time.monotonic()
+    manifest['timings'] = {'list': t1 - t0, 'folders': 0.0, 'copy': t2 - t1, 'total': t2 - t0}
+    logger.info(f'Synced {dbx_folder} to s3://{bn}/{prefix}: {len(manifest["copied"])} copied, '
+                f'{len(manifest["skipped"])} skipped, {len(manifest["failed"])} failed')
+    return manifest
+
+def dau_sync_from_s3(logger,bn,prefix,dbx_as_user,dbx_folder,max_workers=None):
+    '''This function mirrors an s3 prefix to a dropbox folder tree
+    A file is skipped when the dropbox copy has the content_hash recorded on
+    the s3 object, or failing that the same size and a newer modified time
+    :param: logger=the logging handle
+    :param: bn=s3 bucket name to read from
+    :param: prefix=the key prefix to read under ie statements/
+    :param: dbx_as_user=the dropbox session
+    :param: dbx_folder=the dropbox folder to copy to ie /Statements
+    :param: max_workers=copies in flight, None uses SYNC_WORKERS
+    :returns: a manifest dict of copied, skipped and failed files and timings
+    '''
+    dbx_as_user = _dbx_client(dbx_as_user)
+    manifest = _sync_manifest()
+    t0 = time.monotonic()
+    root = dbx_folder.rstrip('/')
+    objects = {k: o for k, o in list_s3_prefix(logger, bn, prefix).items() if not k.endswith('/')}
+    folders = {root.lower()}
+    try:
+        entries = dau_list_folder(logger, dbx_as_user, root)
+    except dropbox.exceptions.ApiError as e:
+        if not (e.error.is_path() and e.error.get_path().is_not_found()):
+            raise
+        entries = []
+        folders.clear()
+    files = {e.path_lower: e for e in entries if isinstance(e, dropbox.files.FileMetadata)}
+    folders.update(e.path_lower for e in entries if isinstance(e, dropbox.files.FolderMetadata))
+    t1 = time.monotonic()
+
+    targets = {k: f'{root}/{k[len(prefix):].lstrip("/")}' for k in objects}
+    missing = set()
+    for path in targets.values():
+        parent = path.rsplit('/', 1)[0]
+        while parent and parent.lower() not in folders and parent not in missing:
+            missing.add(parent)
+            parent = parent.rsplit('/', 1)[0]
+    if missing:
+        dau_create_folders(logger, dbx_as_user, sorted(missing))
+    t2 = time.monotonic()
+    s3_client = aws_client('s3')
+    overwrite = dropbox.files.WriteMode.overwrite
+
+    def job(key, path):
+        obj = objects[key]
+
+        def copy():
+            meta = files.get(path.lower())
+            if meta is not None and meta.size == obj['Size']:
+                stored = s3_client.head_object(Bucket=bn, Key=key).get('Metadata', {}).get(DBX_HASH_META)
+                if stored == meta.content_hash:
+                    return False
+                if stored is None and meta.server_modified.replace(tzinfo=timezone.utc) >= obj['LastModified']:
+                    return False
+            s3_to_dropbox(logger, bn, key, dbx_as_user, path, mode=overwrite, cached=False)
+            return True
+        return (key, path, copy)
+
+    _run_sync(logger, [job(k, p) for k, p in targets.items()], max_workers, manifest)
+    t3 = time.monotonic()
+    manifest['timings'] = {'list': t1 - t0, 'folders': t2 - t1, 'copy': t3 - t2, 'total': t3 - t0}
+    logger.info(f'Synced s3://{bn}/{prefix} to {dbx_folder}: {len(manifest["copied"])} copied, '
+                f'{len(manifest["skipped"])} skipped, {len(manifest["failed"])} failed')
+    return manifest
+
+#one pool of keep-alive connections per vault endpoint, shared by every call
+#in the container so we only pay the TCP and TLS handshake once
+VAULT_TIMEOUT = float(os.environ.get('LCFS_VAULT_TIMEOUT', '10'))
+VAULT_CONNECT_TIMEOUT = float(os.environ.get('LCFS_VAULT_CONNECT_TIMEOUT', '3'))
+VAULT_RETRIES = int(os.environ.get('LCFS_VAULT_RETRIES', '3'))
+VAULT_BACKOFF = float(os.environ.get('LCFS_VAULT_BACKOFF', '0.2'))
+VAULT_WORKERS = int(os.environ.get('LCFS_VAULT_WORKERS', '8'))
+_vault_clients = {}
+_vault_lock = threading.Lock()
+
+class VaultCache:
+    '''Bounded LRU and TTL cache for vault lookups, so repeated values skip
+    the round trip. Lookups are keyed by an HMAC of the endpoint, operation
+    and input under a random per process key, so plaintext inputs are never
+    held as keys. Results are kept as bytearrays and zeroed when evicted,
+    expired or cleared. Neither keys nor values are ever logged
+    '''
+
+    def __init__(self, max_entries=1024, max_bytes=1024 * 1024, ttl=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._secret = os.urandom(32)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _digest(self, scope, value):
+        return hmac.new(self._secret, f'{scope}\0{value}'.encode(), hashlib.sha256).digest()
+
+    def _drop(self, digest):
+        value, _ = self._data.pop(digest)
+        self._bytes -= len(value) + len(digest)
+        value[:] = b'\0' * len(value)
+
+    def get(self, scope, value):
+        '''Returns the cached result or None'''
+        digest = self._digest(scope, value)
+        with self._lock:
+            entry = self._data.get(digest)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._drop(digest)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(digest)
+            self.hits += 1
+            return entry[0].decode()
+
+    def put(self, scope, value, result):
+        '''Caches a result, error strings are never cached'''
+        if not isinstance(result, str) or result.startswith('ERROR:'):
+            return
+        digest = self._digest(scope, value)
+        data = bytearray(result.encode())
+        if len(data) + len(digest) > self.max_bytes:
+            return
+        with self._lock:
+            if digest in self._data:
+                self._drop(digest)
+            self._data[digest] = (data, time.monotonic() + self.ttl)
+            self._bytes += len(data) + len(digest)
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        '''Zeroes and drops every entry'''
+        with self._lock:
+            while self._data:
+                self._drop(next(iter(self._data)))
+
+    def stats(self):
+        '''Returns the hit, miss and eviction counters and current size'''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._data), 'bytes': self._bytes}
+
+_vault_cache = None
+
+def enable_vault_cache(max_entries=1024, max_bytes=1024 * 1024, ttl=300):
+    '''This function turns on the shared cache used by get_token, get_tv,
+    get_hash and VaultClient
+    :param: max_entries=the most results kept
+    :param: max_bytes=the most bytes of results kept
+    :param: ttl=seconds a result is served from cache
+    :returns: the VaultCache
+    '''
+    global _vault_cache
+    disable_vault_cache()
+    _vault_cache = VaultCache(max_entries, max_bytes, ttl)
+    return _vault_cache
+
+def disable_vault_cache():
+    '''This function turns off the shared vault cache, zeroing its entries'''
+    global _vault_cache
+    cache, _vault_cache = _vault_cache, None
+    if cache is not None:
+        cache.clear()
+
+def vault_cache_stats():
+    '''This function returns the shared vault cache counters, None when it is off'''
+    return _vault_cache.stats() if _vault_cache is not None else None
+
+if os.environ.get('LCFS_VAULT_CACHE'):
+    enable_vault_cache(int(os.environ.get('LCFS_VAULT_CACHE_ENTRIES', '1024')),
+                       int(os.environ.get('LCFS_VAULT_CACHE_BYTES', str(1024 * 1024))),
+                       float(os.environ.get('LCFS_VAULT_CACHE_TTL', '300')))
+
+class VaultClient:
+    '''Calls the Left Coast tokenization service over a shared connection pool
+    Requests that fail to connect, time out or come back 429/5xx are retried
+    with exponential backoff. The bulk method runs many values concurrently
+    and returns results in input order, failures as ERROR strings like the
+    get_token, get_tv and get_hash helpers. Results go through cache, or the
+    shared vault cache when one is enabled
+    '''
+
+    def __init__(self, url, apiKey, timeout=None, connect_timeout=None, retries=None, backoff=None, maxsize=None,
+                 cache=None):
+        self.url = url
+        self.cache = cache
+        self.headers = {'x-api-key': apiKey}
+        self.maxsize = maxsize or VAULT_WORKERS
+        retries = VAULT_RETRIES if retries is None else retries
+        retry = urllib3.util.Retry(total=retries, connect=retries, read=retries,
+                                   backoff_factor=VAULT_BACKOFF if backoff is None else backoff,
+                                   status_forcelist=(429, 500, 502, 503, 504),
+                                   allowed_methods=frozenset(['POST']), raise_on_status=False)
+        self.http = urllib3.PoolManager(
+            maxsize=self.maxsize, retries=retry,
+            timeout=urllib3.util.Timeout(connect=connect_timeout or VAULT_CONNECT_TIMEOUT,
+                                         read=timeout or VAULT_TIMEOUT))
+
+    def _post(self, op, field, value, result):
+        cache = self.cache if self.cache is not None else _vault_cache
+        scope = f'{self.url}|{field}'
+        if cache is not None:
+            hit = cache.get(scope, value)
+            if hit is not None:
+                return hit
+        body = json.dumps({field: value})
+        with timed_call('vault', op, len(body)) as call:
+            response = self.http.request('POST', self.url, headers=self.headers, body=body)
+            call.nbytes += len(response.data)
+            call.retries = len(response.retries.history) if response.retries else 0
+            call.error = response.status >= 400
+        item = json.loads(response.data)
+        if cache is not None:
+            cache.put(scope, value, item[result])
+        return item[result]
+
+    def tokenize(self, secret):
+        '''Returns the token for a plaintext value'''
+        return self._post('tokenize', 'plaintext_item', secret, 'token')
+
+    def detokenize(self, hash):
+        '''Returns the plaintext value for a vault hash'''
+        return self._post('detokenize', 'hash', hash, 'plaintext_value')
+
+    def hash(self, token):
+        '''Returns the vault hash for a token'''
+        return self._post('hash', 'token', token, 'hash')
+
+    def bulk(self, op, values, max_workers=None):
+        '''Runs tokenize, detokenize or hash over a list of values concurrently
+        :param: op=one of tokenize, detokenize or hash
+        :param: values=the values to send
+        :param: max_workers=calls in flight, None uses the pool size
+        :returns: a list of results in the same order as values
+        '''
+        fn = {'tokenize': self.tokenize, 'detokenize': self.detokenize, 'hash': self.hash}[op]
+
+        def run(value):
+            try:
+                return fn(value)
+            except (HTTPError, urllib3.exceptions.HTTPError, ValueError, KeyError) as e:
+                return f'ERROR: {e}'
+
+        values = list(values)
+        unique = list(dict.fromkeys(values))
+        if not unique:
+            return []
+        workers = max(1, min(max_workers or self.maxsize, len(unique)))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            results = dict(zip(unique, ex.map(run, unique)))
+        return [results[v] for v in values]
+
+def vault_client(url, apiKey, **kw):
+    '''This function returns the shared VaultClient for an endpoint and key
+    :param: url=this is the encryption service URL
+    :param: apiKey=this is the apiKey used to access the API gateway endpoint
+    :param: kw=VaultClient options used the first time the client is built
+    :returns: the VaultClient
+    '''
+    key = (url, apiKey)
+    client = _vault_clients.get(key)
+    if client is None:
+        with _vault_lock:
+            client = _vault_clients.get(key)
+            if client is None:
+                client = VaultClient(url, apiKey, **kw)
+                _vault_clients[key] = client
+    return client
+
 def get_token(logger,url,apiKey,secret):
     '''
     This function calls the Left Coast encryption service to either return the token
@@ -332,22 +2488,14 @@ def get_token(logger,url,apiKey,secret):
     :returns:   a token that represents the secret
     '''
     logger.info(f'Calling our encryption service to get a token')
-    encoded_body = json.dumps({"plaintext_item": secret})
     try:
-        http = urllib3.PoolManager()
-        h={'x-api-key':apiKey}
-        response = http.request('POST',url,
-                                headers=h,
-                                body=encoded_body)
-    except HTTPError as e:
+        token = vault_client(url, apiKey).tokenize(secret)
+    except (HTTPError, urllib3.exceptions.HTTPError) as e:
         logger.info(f'Http request threw error {e}')
-        logger.debug(f'URL called: {url}')
-        logger.debug(f'Header passed: {h}')
+        logger.debug('URL called: %s', url)
         return f'ERROR: {e}'
-    
-    item = json.loads(response.data)
-    logger.info(f'This is the item returned: {item}')
-    return item["token"]
+    logger.info(f'Token returned')
+    return token
 
 def get_tv(logger,url,apiKey,hash):
     '''
@@ -358,22 +2506,14 @@ def get_tv(logger,url,apiKey,hash):
     :returns:   the plaintext value
     '''
     logger.info(f'Calling our encryption service to get a token')
-    unencoded_body = json.dumps({"hash": hash})
     try:
-        http = urllib3.PoolManager()
-        h={'x-api-key':apiKey}
-        response = http.request('POST',url,
-                                headers=h,
-                                body=unencoded_body)
-    except HTTPError as e:
+        value = vault_client(url, apiKey).detokenize(hash)
+    except (HTTPError, urllib3.exceptions.HTTPError) as e:
         logger.info(f'Http request threw error {e}')
-        logger.debug(f'URL called: {url}')
-        logger.debug(f'Header passed: {h}')
+        logger.debug('URL called: %s', url)
         return f'ERROR: {e}'
-    
-    item = json.loads(response.data)
-    logger.info(f'This is the item returned: {item}')
-    return item["plaintext_value"]
+    logger.info(f'Plaintext value returned')
+    return value
 
 def get_hash(logger,url,apiKey,token):
     '''
@@ -385,26 +2525,34 @@ def get_hash(logger,url,apiKey,token):
     :returns:   a hash value that is the key in the vault for the plaintext value
     '''
     logger.info(f'Calling our encryption service to get a hash')
-    t = json.dumps({"token": token})
     try:
-        http = urllib3.PoolManager()
-        h={'x-api-key':apiKey}
-        response = http.request('POST',url,
-                                headers=h,
-                                body=t)
-    except HTTPError as e:
+        value = vault_client(url, apiKey).hash(token)
+    except (HTTPError, urllib3.exceptions.HTTPError) as e:
         logger.info(f'Http request threw error {e}')
-        logger.debug(f'URL called: {url}')
-        logger.debug(f'Header passed: {h}')
+        logger.debug('URL called: %s', url)
         return f'ERROR: {e}'
-    
-    item = json.loads(response.data)
-    logger.info(f'This is the item returned: {item}')
-    return item["hash"]
+    logger.info(f'Hash returned')
+    return value
+
+def prepare_attachments(attachments: list) -> list:
+    """
+    Reads attachment files once and builds their MIME parts, so a bulk send
+    can share the same parts across every recipient's message.
+
+    :param attachments: List of files to attach.
+    :return: A list of MIME parts that create_multipart_message accepts as attachments.
+    """
+    parts = []
+    for attachment in attachments or []:
+        with open(attachment, 'rb') as f:
+            part = _mime_application.MIMEApplication(f.read())
+        part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment))
+        parts.append(part)
+    return parts
 
 def create_multipart_message(
         sender: str, recipients: list, title: str, cc: list=None, text: str=None, html: str=None, bcc: list=None, attachments: list=None)\
-        -> MIMEMultipart:
+        -> 'MIMEMultipart':
     """
     Creates a MIME multipart message object.
     Uses only the Python `email` standard library.
@@ -415,35 +2563,35 @@ def create_multipart_message(
     :param title: The title of the email.
     :param text: The text version of the email body (optional).
     :param html: The html version of the email body (optional).
-    :param attachments: List of files to attach in the email.
+    :param attachments: List of files to attach in the email, or parts from prepare_attachments.
     :return: A `MIMEMultipart` to be used to send the email.
     """
     logger.info(f'Creating multipart MIME message')
-    logger.debug(f'cc list: {type(cc)}')
+    logger.debug('cc list: %s', type(cc))
     multipart_content_subtype = 'alternative' #if text and html else 'mixed'
-    msg = MIMEMultipart(multipart_content_subtype)
+    msg = _mime_multipart.MIMEMultipart(multipart_content_subtype)
     msg['Subject'] = title
     msg['From'] = sender
     msg['To'] = ', '.join(recipients)
-    msg['CC'] = ', '.join(cc)
+    if cc:
+        msg['CC'] = ', '.join(cc)
     if bcc:
         msg['BCC'] = ', '.join(bcc)
 
     # Record the MIME types of both parts - text/plain and text/html.
     # According to RFC 2046, the last part of a multipart message, in this case the HTML message, is best and preferred.
     if text:
-        part = MIMEText(text, 'plain')
+        part = _mime_text.MIMEText(text, 'plain')
         msg.attach(part)
     if html:
-        part = MIMEText(html, 'html')
+        part = _mime_text.MIMEText(html, 'html')
         msg.attach(part)
 
-    # Add attachments
+    # Add attachments, files are read here while prepared parts are shared as is
+    paths = [a for a in attachments or [] if isinstance(a, (str, os.PathLike))]
+    prepared = iter(prepare_attachments(paths))
     for attachment in attachments or []:
-        with open(attachment, 'rb') as f:
-            part = MIMEApplication(f.read())
-            part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment))
-            msg.attach(part)
+        msg.attach(next(prepared) if isinstance(attachment, (str, os.PathLike)) else attachment)
 
     return msg
 
@@ -454,70 +2602,648 @@ def send_mail(
     The sender needs to be a verified email in SES.
     """
     msg = create_multipart_message(sender, recipients, title, cc, text, html, bcc, attachments)
-    ses_client = boto3.client('ses')  # Use your settings here
-    logger.debug(f'[LCFSLAMBDALIB] recipients: {recipients}')
+    ses_client = aws_client('ses')  # Use your settings here
+    logger.debug('[LCFSLAMBDALIB] recipients: %s', recipients)
     if cc:
         recipients = recipients + cc
-        logger.debug(f'[LCFSLAMBDALIB] cc: {cc}')
+        logger.debug('[LCFSLAMBDALIB] cc: %s', cc)
     if bcc:
-        logger.debug(f'[LCFSLAMBDALIB] bcc: {bcc}')
+        logger.debug('[LCFSLAMBDALIB] bcc: %s', bcc)
         recipients = recipients = recipients + bcc
-    logger.debug(f'[LCFSLAMBDALIB] recipients: {recipients}')
+    logger.debug('[LCFSLAMBDALIB] recipients: %s', recipients)
     return ses_client.send_raw_email(
         Source=sender,
         Destinations=recipients,
-        RawMessage={'Data': msg.as_string()}
+        RawMessage={'Data': msg.as_bytes()}
     )
 
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter.
+    Tokens refill at rate per second up to capacity, acquire blocks until enough are available.
+    A caller takes its tokens up front, going into debt when there are not enough, and then
+    waits the debt out, so a request larger than capacity is still paid for in full.
+    """
+
+    def __init__(self, rate: float, capacity: float=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1.0))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float=1) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait_for = -self._tokens / self.rate
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+MAIL_WORKERS = int(os.environ.get('LCFS_MAIL_WORKERS', '8'))
+_ses_send_rate = None
+
+def ses_max_send_rate() -> float:
+    """
+    Returns the account's SES MaxSendRate (recipients per second), looked up once per container.
+    """
+    global _ses_send_rate
+    if _ses_send_rate is None:
+        _ses_send_rate = float(aws_client('ses').get_send_quota()['MaxSendRate'])
+    return _ses_send_rate
+
+def send_bulk_mail(sender: str, messages: list, attachments: list=None, max_workers: int=None, rate: float=None) -> list:
+    """
+    Sends many emails concurrently, throttled to the SES max send rate.
+    The attachments are read and encoded once and shared by every message.
+    The sender needs to be a verified email in SES.
+
+    :param sender: The sender.
+    :param messages: List of dicts with recipients and title, and optionally cc, bcc, text, html and
+        attachments (extra files for just that message).
+    :param attachments: List of files attached to every message.
+    :param max_workers: Sends in flight, None uses MAIL_WORKERS.
+    :param rate: Recipients per second, None uses the account's SES MaxSendRate.
+    :return: A list in the same order as messages, each with the recipients and either MessageId or error.
+    """
+    shared = prepare_attachments(attachments)
+    bucket = TokenBucket(rate or ses_max_send_rate())
+    ses_client = aws_client('ses')
+
+    #a transport error or a malformed message dict fails only that message, so
+    #the caller always learns which mails SES already accepted
+    def send(m):
+        result = {'recipients': []}
+        try:
+            destinations = list(m['recipients']) + list(m.get('cc') or []) + list(m.get('bcc') or [])
+            result['recipients'] = destinations
+            msg = create_multipart_message(sender, m['recipients'], m['title'], m.get('cc'), m.get('text'),
+                                           m.get('html'), m.get('bcc'), shared + list(m.get('attachments') or []))
+            data = msg.as_bytes()
+            bucket.acquire(len(destinations))
+            resp = ses_client.send_raw_email(Source=sender, Destinations=destinations, RawMessage={'Data': data})
+            result['MessageId'] = resp['MessageId']
+        except (_botocore_exceptions.ClientError, _botocore_exceptions.BotoCoreError, OSError,
+                KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.info(f'[LCFSLAMBDALIB] send failed: {e!r}')
+            result['error'] = f'missing {e}' if isinstance(e, KeyError) else str(e)
+        return result
+
+    if not messages:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers or MAIL_WORKERS, len(messages)))) as ex:
+        results = list(ex.map(send, messages))
+    logger.info(f'[LCFSLAMBDALIB] sent {sum(1 for r in results if "MessageId" in r)} of {len(messages)} mails')
+    return results
+
+#lookups go to Query on the table or index whose keys match the query and only
+#fall back to a parallel segmented Scan when nothing fits. Table key schemas
+#are described once per container. The helpers call the shared thread safe
+#client through _ddb_call instead of building a boto3 resource per thread
+DDB_SCAN_SEGMENTS = int(os.environ.get('LCFS_DDB_SCAN_SEGMENTS', '4'))
+DDB_MAX_WORKERS = int(os.environ.get('LCFS_DDB_MAX_WORKERS', '16'))
+_ddb_schemas = {}
+_ddb_pool_lock = threading.Lock()
+_ddb_executor = None
+
+def _ddb_pool():
+    '''Returns the long lived pool for ddb work'''
+    global _ddb_executor
+    with _ddb_pool_lock:
+        if _ddb_executor is None:
+            _ddb_executor = ThreadPoolExecutor(max_workers=DDB_MAX_WORKERS, thread_name_prefix='lcfs-ddb')
+    return _ddb_executor
+
+def _ddb_call(method, **params):
+    '''Calls a dynamodb client method with the arguments a boto3 Table takes,
+    python values and Key/Attr conditions, and returns python values back.
+    It does what the resource does on its own client, with a fresh
+    transformer per call since the resource's one is not thread safe'''
+    client = aws_client('dynamodb')
+    model = client.meta.service_model.operation_model(client.meta.method_to_api_mapping[method])
+    injector = _ddb_transform.TransformationInjector()
+    params = _ddb_transform.copy_dynamodb_params(params)
+    injector.inject_condition_expressions(params, model)
+    injector.inject_attribute_value_input(params, model)
+    parsed = getattr(client, method)(**params)
+    injector.inject_attribute_value_output(parsed, model)
+    return parsed
+
+def ddb_key_schema(table_name):
+    '''This function returns the key schema of a table and its indexes, cached.
+    It needs dynamodb:DescribeTable, roles without it get None and the
+    lookups fall back to scanning as they did before
+    :param:     table_name=the name of the DDB table
+    :returns:   a list of dicts with index (None for the table), hash, range,
+                projection and the set of attrs the index holds, or None when
+                the role may not describe the table
+    '''
+    if table_name in _ddb_schemas:
+        return _ddb_schemas[table_name]
+    try:
+        desc = aws_client('dynamodb').describe_table(TableName=table_name)['Table']
+    except _botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'AccessDeniedException':
+            raise
+        logger.info(f'No dynamodb:DescribeTable on {table_name}, lookups will scan')
+        _ddb_schemas[table_name] = None
+        return None
+
+    def keys(key_schema):
+        h = next(k['AttributeName'] for k in key_schema if k['KeyType'] == 'HASH')
+        r = next((k['AttributeName'] for k in key_schema if k['KeyType'] == 'RANGE'), None)
+        return h, r
+
+    th, tr = keys(desc['KeySchema'])
+    schema = [{'index': None, 'hash': th, 'range': tr, 'projection': 'ALL', 'attrs': None}]
+    for idx in desc.get('GlobalSecondaryIndexes', []) + desc.get('LocalSecondaryIndexes', []):
+        if idx.get('IndexStatus', 'ACTIVE') != 'ACTIVE':
+            continue
+        h, r = keys(idx['KeySchema'])
+        proj = idx['Projection']
+        attrs = {th, tr, h, r} | set(proj.get('NonKeyAttributes', []))
+        attrs.discard(None)
+        schema.append({'index': idx['IndexName'], 'hash': h, 'range': r,
+                       'projection': proj['ProjectionType'], 'attrs': attrs})
+    _ddb_schemas[table_name] = schema
+    return schema
+
+def _ddb_pick_index(schema, query, projection):
+    '''Picks the table or index that can serve query, preferring one whose
+    range key is also in the query and the table itself on a tie'''
+    best = None
+    for idx in schema or []:
+        if idx['hash'] not in query:
+            continue
+        if idx['projection'] != 'ALL':
+            if projection is None or not (set(projection) | set(query)) <= idx['attrs']:
+                continue
+        score = 2 if idx['range'] in query else 1
+        if best is None or score > best[0]:
+            best = (score, idx)
+    return best[1] if best else None
+
+def _ddb_pages(op, kw):
+    '''Yields each page of items from a query or scan, following LastEvaluatedKey'''
+    kw = dict(kw)
+    while True:
+        resp = op(**kw)
+        yield resp.get('Items', [])
+        if not resp.get('LastEvaluatedKey'):
+            return
+        kw['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def _ddb_parallel_scan(table_name, segments, kw):
+    '''Yields items from a scan split into segments that run concurrently'''
+    if segments <= 1:
+        for page in _ddb_pages(functools.partial(_ddb_call, 'scan', TableName=table_name), kw):
+            yield from page
+        return
+    pages = queue.Queue(maxsize=segments * 2)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run(segment):
+        try:
+            scan = functools.partial(_ddb_call, 'scan', TableName=table_name)
+            for page in _ddb_pages(scan, dict(kw, Segment=segment, TotalSegments=segments)):
+                if stop.is_set():
+                    return
+                put(page)
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    for segment in range(segments):
+        _ddb_pool().submit(run, segment)
+    finished = 0
+    try:
+        while finished < segments:
+            item = pages.get()
+            if item is done:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+
+def _ddb_projection(projection):
+    '''Builds ProjectionExpression args with placeholder names so reserved
+    words like name and status can be projected'''
+    names = {f'#p{i}': a for i, a in enumerate(projection)}
+    return {'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+
+def ddb_query(table_name,query,projection=None,segments=None,stream=False):
+    '''This function looks up items by attribute equality using the cheapest
+    read it can. When the table or one of its indexes has its hash key in the
+    query it runs a Query, with the range key too if present, and filters on
+    the rest. Otherwise it runs a parallel segmented Scan. Every page is read
+    :param:     table_name=the name of the DDB table
+    :param:     query=a dict of attribute name to the value it must equal
+    :param:     projection=a list of attributes to return, None returns all
+    :param:     segments=scan segments when no index fits, None uses DDB_SCAN_SEGMENTS
+    :param:     stream=return a generator instead of a list
+    :returns:   the matching items
+    '''
+    items = _ddb_query_items(table_name, query, projection, segments or DDB_SCAN_SEGMENTS)
+    return items if stream else list(items)
+
+def _ddb_query_items(table_name, query, projection, segments):
+    kw = _ddb_projection(projection) if projection else {}
+    idx = _ddb_pick_index(ddb_key_schema(table_name), query, projection)
+    if idx is None:
+        logger.debug('No index on %s fits %s, scanning in %s segment(s)', table_name, list(query), segments)
+        if query:
+            kw['FilterExpression'] = reduce(_ddb_conditions.And, [_ddb_conditions.Attr(k).eq(v) for k, v in query.items()])
+        yield from _ddb_parallel_scan(table_name, segments, kw)
+        return
+    logger.debug('Querying %s on index %s', table_name, idx["index"] or "primary")
+    cond = _ddb_conditions.Key(idx['hash']).eq(query[idx['hash']])
+    if idx['range'] in query:
+        cond = cond & _ddb_conditions.Key(idx['range']).eq(query[idx['range']])
+    rest = [_ddb_conditions.Attr(k).eq(v) for k, v in query.items() if k not in (idx['hash'], idx['range'])]
+    if rest:
+        kw['FilterExpression'] = reduce(_ddb_conditions.And, rest)
+    if idx['index']:
+        kw['IndexName'] = idx['index']
+    kw['KeyConditionExpression'] = cond
+    for page in _ddb_pages(functools.partial(_ddb_call, 'query', TableName=table_name), kw):
+        yield from page
+
+#bulk inserts go through BatchWriteItem 25 items at a time with the batches
+#spread over the ddb pool. UnprocessedItems are resubmitted with exponential
+#backoff and full jitter
+DDB_BATCH_WRITE_SIZE = 25
+DDB_WRITE_WORKERS = int(os.environ.get('LCFS_DDB_WRITE_WORKERS', '4'))
+DDB_WRITE_RETRIES = int(os.environ.get('LCFS_DDB_WRITE_RETRIES', '8'))
+#only throttling, server side errors and lost connections are worth another
+#try, anything else (ValidationException, AccessDeniedException) fails the
+#batch straight away
+DDB_RETRYABLE_ERRORS = frozenset(['ProvisionedThroughputExceededException', 'ThrottlingException',
+                                  'RequestLimitExceeded', 'InternalServerError', 'ServiceUnavailable'])
+
+def _ddb_write_batch(table_name, chunk, max_retries):
+    '''Writes one batch of up to 25 items, resubmitting UnprocessedItems and
+    whole batches that failed with a retryable error'''
+    request = {table_name: [{'PutRequest': {'Item': item}} for item in chunk]}
+    stats = {'written': 0, 'wcu': 0.0, 'retries': 0, 'unprocessed': []}
+    attempt = 0
+    while request:
+        try:
+            resp = _ddb_call('batch_write_item', RequestItems=request, ReturnConsumedCapacity='TOTAL')
+        except _botocore_exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            logger.info(f'Batch write to {table_name} failed: {code}')
+            if code not in DDB_RETRYABLE_ERRORS:
+                stats['unprocessed'] = [r['PutRequest']['Item'] for r in request[table_name]]
+                break
+            resp = {'UnprocessedItems': request}
+        except _botocore_exceptions.BotoCoreError as e:
+            logger.info(f'Batch write to {table_name} failed: {e}')
+            resp = {'UnprocessedItems': request}
+        for cc in resp.get('ConsumedCapacity', []):
+            stats['wcu'] += cc.get('CapacityUnits', 0)
+        unprocessed = resp.get('UnprocessedItems') or {}
+        left = unprocessed.get(table_name, [])
+        stats['written'] += len(request[table_name]) - len(left)
+        if not left:
+            break
+        if attempt >= max_retries:
+            stats['unprocessed'] = [r['PutRequest']['Item'] for r in left]
+            break
+        time.sleep(random.uniform(0, min(0.05 * (2 ** attempt), 5)))
+        attempt += 1
+        stats['retries'] += 1
+        request = unprocessed
+    return stats
+
+def _ddb_put_if_absent(table_name, item, key_attr):
+    '''Writes one item unless one with the same key exists
+    :returns: (outcome, wcu) where outcome is written, existing or failed'''
+    try:
+        resp = _ddb_call('put_item', TableName=table_name, Item=item,
+                         ConditionExpression=_ddb_conditions.Attr(key_attr).not_exists(),
+                         ReturnConsumedCapacity='TOTAL')
+    except _botocore_exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return 'existing', 0.0
+        logger.info(f'Put to {table_name} failed: {e.response["Error"]["Code"]}')
+        return 'failed', 0.0
+    return 'written', resp.get('ConsumedCapacity', {}).get('CapacityUnits', 0.0)
+
+def ddb_batch_write(table_name,items,max_workers=None,max_retries=None,conditional_fallback=False,key_attr=None):
+    '''This function bulk inserts items with BatchWriteItem
+    Items that share a key are collapsed to the last one, since a batch may
+    not hold the same key twice, which needs dynamodb:DescribeTable to know the
+    key
+    :param:     table_name=the name of the DDB table
+    :param:     items=the items to put
+    :param:     max_workers=batches in flight, None uses DDB_WRITE_WORKERS
+    :param:     max_retries=resubmits of UnprocessedItems, None uses DDB_WRITE_RETRIES
+    :param:     conditional_fallback=write items still unprocessed after the
+                retries one at a time with put_item, only if no item with the
+                same key exists, so re-running an ingest never overwrites
+    :param:     key_attr=the table's hash key for conditional_fallback, None
+                reads it from the key schema, needed when the role may not
+                call DescribeTable
+    :return:    a report dict of written, existing and failed counts, the
+                failed items, consumed WCUs, batches, retries, elapsed seconds
+                and items and WCUs per second
+    '''
+    t0 = time.monotonic()
+    max_retries = DDB_WRITE_RETRIES if max_retries is None else max_retries
+    schema = ddb_key_schema(table_name)
+    if schema is not None:
+        key_attrs = [k for k in (schema[0]['hash'], schema[0]['range']) if k]
+        items = list({tuple(repr(i.get(k)) for k in key_attrs): i for i in items}.values())
+        key_attr = key_attr or key_attrs[0]
+    if conditional_fallback and key_attr is None:
+        raise ValueError(f'conditional_fallback on {table_name} needs key_attr, the key schema could not be read')
+    chunks = [items[i:i + DDB_BATCH_WRITE_SIZE] for i in range(0, len(items), DDB_BATCH_WRITE_SIZE)]
+    slots = threading.BoundedSemaphore(max_workers or DDB_WRITE_WORKERS)
+
+    def run(chunk):
+        try:
+            return _ddb_write_batch(table_name, chunk, max_retries)
+        finally:
+            slots.release()
+
+    futures = []
+    for chunk in chunks:
+        slots.acquire()
+        futures.append(_ddb_pool().submit(run, chunk))
+    report = {'written': 0, 'existing': 0, 'failed': 0, 'failed_items': [], 'consumed_wcu': 0.0,
+              'batches': len(chunks), 'retries': 0}
+    for f in futures:
+        stats = f.result()
+        report['written'] += stats['written']
+        report['consumed_wcu'] += stats['wcu']
+        report['retries'] += stats['retries']
+        report['failed_items'].extend(stats['unprocessed'])
+    if conditional_fallback and report['failed_items']:
+        leftover, report['failed_items'] = report['failed_items'], []
+        logger.info(f'Falling back to conditional puts for {len(leftover)} item(s)')
+        for item, (outcome, wcu) in zip(leftover, _ddb_pool().map(
+                lambda i: _ddb_put_if_absent(table_name, i, key_attr), leftover)):
+            report['consumed_wcu'] += wcu
+            if outcome == 'failed':
+                report['failed_items'].append(item)
+            else:
+                report[outcome] += 1
+    report['failed'] = len(report['failed_items'])
+    elapsed = time.monotonic() - t0
+    report['elapsed'] = elapsed
+    report['items_per_sec'] = report['written'] / elapsed if elapsed else 0.0
+    report['wcu_per_sec'] = report['consumed_wcu'] / elapsed if elapsed else 0.0
+    logger.info(f'Wrote {report["written"]} of {len(items)} item(s) to {table_name} in {elapsed:.2f}s, '
+                f'{report["consumed_wcu"]} WCU, {report["failed"]} failed')
+    return report
+
+#duplicate detection matches on a normalized fingerprint of payee_invoice, name
+#and amount. Tables that store it in this attribute with a GSI on it get a
+#Query per fingerprint, otherwise we fall back to an index on payee_invoice
+#and then to one scan per 100 invoices in the batch. The fallbacks look up the
+#raw payee_invoice and name, so only the fingerprint path matches across case
+#and whitespace differences
+DUP_FINGERPRINT_ATTR = os.environ.get('LCFS_DUP_FINGERPRINT_ATTR', 'dup_fingerprint')
+DDB_BATCH_GET_SIZE = 100
+
+def dup_fingerprint(item):
+    '''This function builds the duplicate fingerprint for a transaction
+    :param:     item=the transaction, needs payee_invoice, name and amount
+    :return:    the fingerprint string, store it in DUP_FINGERPRINT_ATTR on insert
+    '''
+    invoice = str(item.get('payee_invoice', '')).strip().lower()
+    name = ' '.join(str(item.get('name', '')).split()).lower()
+    amount = item.get('amount', '')
+    try:
+        amount = format(Decimal(str(amount)).normalize(), 'f')
+    except InvalidOperation:
+        amount = str(amount).strip()
+    return f'{invoice}|{name}|{amount}'
+
+def _dup_record(trans, item, source):
+    '''Describes a possible duplicate, trans is the earlier transaction'''
+    return {
+        'transaction_num1' : trans.get('transaction'),
+        'payer_name1' : trans.get('payer_name'),
+        'amount1' : trans.get('amount'),
+        'vendor_name1' : trans.get('name_on_account'),
+        'date1' : trans.get('timestamp'),
+        'transaction_num2' : item.get('transaction'),
+        'payer_name2' : item.get('payer_name'),
+        'vendor_name2' : item.get('name_on_account'),
+        'amount2' : item.get('amount'),
+        'date' : item.get('timestamp'),
+        'source' : source
+    }
+
+def _ddb_batch_get(table_n, key_attr, values):
+    '''Yields the items for a list of hash key values with BatchGetItem,
+    resubmitting UnprocessedKeys with backoff'''
+    for i in range(0, len(values), DDB_BATCH_GET_SIZE):
+        request = {table_n: {'Keys': [{key_attr: v} for v in values[i:i + DDB_BATCH_GET_SIZE]]}}
+        attempt = 0
+        while request:
+            resp = _ddb_call('batch_get_item', RequestItems=request)
+            yield from resp.get('Responses', {}).get(table_n, [])
+            request = resp.get('UnprocessedKeys')
+            if request:
+                time.sleep(min(0.05 * (2 ** attempt), 2))
+                attempt += 1
+
+def _dup_candidates(table_n, items, fp_attr, status):
+    '''Yields stored transactions that might match items, using the cheapest
+    read the table supports'''
+    schema = ddb_key_schema(table_n)
+    fps = list(dict.fromkeys(dup_fingerprint(i) for i in items))
+    idx = _ddb_pick_index(schema, {fp_attr: None}, None)
+    if idx is not None and idx['index'] is None and idx['range'] is None:
+        logger.debug('Duplicate check on %s via BatchGetItem', table_n)
+        for trans in _ddb_batch_get(table_n, fp_attr, fps):
+            if trans.get('status') == status:
+                yield trans
+        return
+    #status is matched in memory rather than put in the lookups, so ddb_query
+    #cannot pick a status index and read the whole partition once per lookup
+    if idx is not None:
+        lookups = [{fp_attr: fp} for fp in fps]
+    else:
+        pairs = dict.fromkeys((i['payee_invoice'], i['name']) for i in items)
+        if _ddb_pick_index(schema, {'payee_invoice': None, 'name': None}, None) is not None:
+            lookups = [{'payee_invoice': inv, 'name': name} for inv, name in pairs]
+        elif _ddb_pick_index(schema, {'status': None}, None) is not None:
+            logger.debug('Duplicate check on %s via one status query', table_n)
+            yield from ddb_query(table_n, {'status': status}, stream=True)
+            return
+        else:
+            logger.debug('No index on %s for duplicate checks, scanning', table_n)
+            invoices = list(dict.fromkeys(inv for inv, _ in pairs))
+            for i in range(0, len(invoices), DDB_BATCH_GET_SIZE):
+                filter_exp = _ddb_conditions.Attr('status').eq(status) & _ddb_conditions.Attr('payee_invoice').is_in(invoices[i:i + DDB_BATCH_GET_SIZE])
+                yield from _ddb_parallel_scan(table_n, DDB_SCAN_SEGMENTS, {'FilterExpression': filter_exp})
+            return
+    logger.debug('Duplicate check on %s via %s queries', table_n, len(lookups))
+    futures = [_ddb_pool().submit(ddb_query, table_n, q) for q in lookups]
+    for f in futures:
+        for trans in f.result():
+            if trans.get('status') == status:
+                yield trans
+
+def find_duplicates(items,table_n,fp_attr=None,status='PENDING'):
+    '''This function checks a batch of incoming transactions for possible
+    duplicates, both against transactions already in the table with the given
+    status and against each other within the batch
+    :param:     items=the list of transactions from quid
+    :param:     table_n=the name of the database table
+    :param:     fp_attr=the attribute holding the fingerprint, None uses DUP_FINGERPRINT_ATTR
+    :param:     status=the status a stored transaction needs to count
+    :return:    a list of dicts of every possible duplicate pair, empty if none
+    '''
+    fp_attr = fp_attr or DUP_FINGERPRINT_ATTR
+    by_fp = {}
+    for item in items:
+        by_fp.setdefault(dup_fingerprint(item), []).append(item)
+    l_dup = []
+    for group in by_fp.values():
+        for item in group[1:]:
+            l_dup.append(_dup_record(group[0], item, 'batch'))
+    if items:
+        seen = set()
+        for trans in _dup_candidates(table_n, items, fp_attr, status):
+            key = trans.get('transaction')
+            fp = trans.get(fp_attr) or dup_fingerprint(trans)
+            if key in seen or fp not in by_fp:
+                continue
+            seen.add(key)
+            for item in by_fp[fp]:
+                if item.get('transaction') != key:
+                    l_dup.append(_dup_record(trans, item, 'table'))
+    logger.info(f'Found {len(l_dup)} possible duplicate(s) in {len(items)} transaction(s)')
+    return l_dup
+
 def check_duplicates(item,table_n):
-    ###Not working
     '''This function checks the transaction table to verify if there is a possible duplicate transaction and
     notifes operations
     :param:     item=the full transaction data from quid
     :param:     table_n=the name of the database table
-    :return:    False or list of dicts of possible duplicate transactions
-    '''
-    db = boto3.resource('dynamodb')
-    table = db.Table(table_n)
-    filter_exp = Attr('status').eq('PENDING') & Attr('payee_invoice').eq(item['payee_invoice']) & Attr('name').eq(item['name'])
-    logger.debug(f'Filter Expression: {filter_exp}')
-    results = table.scan(FilterExpression=filter_exp)
-    logger.debug(f'Results for duplicate check: {results}')
-    r = results.get('Items')
-    l_dup = []
-    if r:
-        for trans in r:
-            if trans['amount'] == item['amount']:
-                #we probably have a duplicate transaction
-                logger.debug(f'Pulled from DDB: {trans}')
-                logger.debug(f'New to be inserted: {item}')
-                d_dup = {
-                    'transaction_num1' : trans['transaction'],
-                    'payer_name1' : trans['payer_name'],
-                    'amount1' : trans['amount'],
-                    'vendor_name1' : trans['name_on_account'],
-                    'date1' : trans['timestamp'],
-                    'payer_name2' : item['payer_name'],
-                    'vendor_name2' : item['name_on_account'],
-                    'amount1' : item['amount'],
-                    'date' : item['timestamp']                    
-                }
-                l_dup.append(d_dup)
-                return l_dup
-            else:
-                return None
-    return None
+    :return:    None or list of dicts of possible duplicate transactions
+    '''
+    l_dup = find_duplicates([item], table_n)
+    return l_dup or None
 
-def get_ddb_res(table_name,query):
+def get_ddb_res(table_name,query,projection=None,stream=False):
     '''This function takes in a table name and a dict of key value parms
-    to scan ddb and get results
+    and gets the matching items, through ddb_query
     :param:     table_name=the name of the DDB table
-    :param:     query=This is a dict of ddb key and ddb value to scan for
+    :param:     query=This is a dict of ddb key and ddb value to look up
+    :param:     projection=a list of attributes to return, None returns all
+    :param:     stream=return a generator instead of a list
     returns     Returns the result set
     '''
-    db = boto3.resource('dynamodb')
-    table = db.Table(table_name)
     logger.info(f'Pulling data from table: {table_name}')
-    results = table.scan(FilterExpression=reduce(And, ([Key(k).eq(v) for k, v in query.items()])))
-    logger.debug(f'Got results: {results["Items"]}')
-    return results['Items']
\ No newline at end of file
+    results = ddb_query(table_name, query, projection=projection, stream=stream)
+    if not stream:
+        logger.debug('Got %s results', len(results))
+    return results
+
+#asyncio counterparts of the helpers a handler usually calls one after the
+#other, so independent ssm, vault, s3, sqs and sns calls can be gathered and
+#the handler waits on the slowest call instead of the sum. boto3, dropbox and
+#urllib3 block, so each call runs on a long lived thread pool sized to the aws
+#connection pool, and gather_limited caps how many are in flight
+ASYNC_WORKERS = int(os.environ.get('LCFS_ASYNC_WORKERS', str(AWS_MAX_POOL_CONNECTIONS)))
+ASYNC_CONCURRENCY = int(os.environ.get('LCFS_ASYNC_CONCURRENCY', str(ASYNC_WORKERS)))
+_async_pool_lock = threading.Lock()
+_async_executor = None
+_async_local = threading.local()
+
+def _async_pool():
+    '''Returns the long lived pool the async helpers run their blocking calls on'''
+    global _async_executor
+    with _async_pool_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix='lcfs-async')
+    return _async_executor
+
+async def run_blocking(fn, *args, **kw):
+    '''This function runs a blocking function on the async pool and waits for it
+    :param: fn=the function to call
+    :param: args=the positional arguments for fn
+    :param: kw=the keyword arguments for fn
+    :returns: what fn returns
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_async_pool(), functools.partial(fn, *args, **kw))
+
+async def gather_limited(*aws, limit=None, return_exceptions=False):
+    '''This function awaits many coroutines with at most limit of them running
+    at a time, coroutines are not started until they get a slot
+    :param: aws=the coroutines to run
+    :param: limit=calls in flight, None uses ASYNC_CONCURRENCY
+    :param: return_exceptions=return exceptions in place of results instead of raising the first one
+    :returns: a list of results in the same order as aws
+    '''
+    slots = asyncio.Semaphore(limit or ASYNC_CONCURRENCY)
+
+    async def run(aw):
+        async with slots:
+            return await aw
+    return await asyncio.gather(*(run(aw) for aw in aws), return_exceptions=return_exceptions)
+
+def run_async(main, *args, **kw):
+    '''This function drives a coroutine to completion from a synchronous lambda
+    handler. Each thread keeps its own event loop across warm invocations
+    :param: main=a coroutine, or an async function to call with args and kw
+    :returns: what the coroutine returns
+    '''
+    if not asyncio.iscoroutine(main):
+        main = main(*args, **kw)
+    loop = getattr(_async_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _async_local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(main)
+
+def async_handler(handler):
+    '''Decorator that lets an async def lambda handler be used as a normal
+    synchronous one
+    '''
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        return run_async(handler, event, context)
+    return wrapper
+
+def _async_version(fn):
+    '''Builds the awaitable counterpart of a blocking helper'''
+    @functools.wraps(fn)
+    async def wrapper(*args, **kw):
+        return await run_blocking(fn, *args, **kw)
+    wrapper.__name__ = wrapper.__qualname__ = f'{fn.__name__}_async'
+    wrapper.__doc__ = f'''Awaitable {fn.__name__}, run on the async pool
+    {fn.__doc__ or ''}'''
+    return wrapper
+
+get_ssm_params_async = _async_version(get_ssm_params)
+ssm_get_parameters_async = _async_version(ssm_get_parameters)
+get_token_async = _async_version(get_token)
+get_tv_async = _async_version(get_tv)
+get_hash_async = _async_version(get_hash)
+read_s3_file_async = _async_version(read_s3_file)
+read_s3_range_async = _async_version(read_s3_range)
+send_sqs_message_async = _async_version(send_sqs_message)
+send_sqs_fifo_message_async = _async_version(send_sqs_fifo_message)
+send_sns_message_async = _async_version(send_sns_message)
+get_ddb_res_async = _async_version(get_ddb_res)